@@ -0,0 +1,169 @@
+#!/usr/bin/env python
+# sch_analyse.py
+# Copyright (C) ContinuumBridge Limited, 2014 - All Rights Reserved
+# Unauthorized copying of this file, via any medium is strictly prohibited
+# Proprietary and confidential
+# Written by Peter Claydon
+#
+"""
+Runs the entry/exit state machines and night wandering detection of the SCH app
+over recorded binary sensor data, to see what they would have reported with other
+thresholds, without a bridge or a database.
+
+The input is one or more trace files, as recorded by the app when "trace_file" is
+set (see sch_replay.py), eg. one for each day. Only the configuration, the adaptor
+names and the binary_sensor data messages are used, at their recorded timeStamps.
+Entry-exit and night wandering settings are taken from the traces' configuration
+and may be overridden with --set. --sweep gives a list of values to try for one
+threshold, and every combination of the swept values is run, in parallel across
+cores. Thresholds are the entry/exit constants of sch_app_a.py or config keys:
+
+    sch_analyse.py trace-*.json
+    sch_analyse.py --sweep IN_PIR_TO_DOOR_TIME=20,30,45 --sweep night_ignore_time=300,600,900 trace-*.json
+"""
+import sys
+import time
+import math
+import json
+import argparse
+import itertools
+import multiprocessing
+import sch_replay  # Installs the stand-ins for the bridge libraries
+import sch_app_a
+
+ACTIONS = ("went_out", "answered_door", "came_in", "open_and_close", "door_open_too_long")
+
+events = None  # (timeStamp, adaptor id, value) of every binary_sensor message, in time order
+names = {}     # adaptor id -> friendly name
+config = {}
+
+class Actions():
+    """ Stands in for DataManager. Records the entry/exit actions, each of which is stored as three values. """
+    def __init__(self):
+        self.actions = []
+
+    def storeEntryExit(self, location, timeStamp, action, v):
+        if v == 1:
+            self.actions.append((location, timeStamp - 1, action))
+
+def cbLog(level, msg):
+    if level in ("warning", "error"):
+        sys.stderr.write(level + ": " + msg + "\n")
+
+def load(fileNames, overrides):
+    """ Reads the traces into module globals, where each worker process of a sweep finds them """
+    global events
+    events = []
+    for fileName in fileNames:
+        traceConfig, traceEvents = sch_replay.readTrace(fileName)
+        config.update(traceConfig)
+        for t, type, message in traceEvents:
+            if type == "configure":
+                for adaptor in message["adaptors"]:
+                    names[adaptor["id"]] = adaptor["friendly_name"]
+            elif type == "data" and message["characteristic"] == "binary_sensor":
+                events.append((message["timeStamp"], message["id"], message["data"]))
+    events.sort(key=lambda e: e[0])
+    config.update(overrides)
+
+def wakeTime(deadline):
+    """ When the timer wheel runs a CheckExit whose deadline this is: after the margin, at the end of a tick """
+    resolution = sch_app_a.config["timer_resolution"]
+    return math.ceil((deadline + sch_app_a.DEADLINE_MARGIN)/resolution)*resolution
+
+def runExits(entryExit):
+    """ Feeds the events to each CheckExit in turn, running it at its deadlines as the timer wheel would """
+    for l in entryExit.locations:
+        checkExit = entryExit.checkExit[l["location"]]
+        sensors = {l["magsw"]: "magsw", l["ipir"]: "ipir"}
+        deadline = None
+        for t, id, value in events:
+            if id in sensors:
+                while deadline is not None and wakeTime(deadline) < t:
+                    deadline = checkExit.run(wakeTime(deadline))
+                checkExit.update(sensors[id], t, value)
+                deadline = checkExit.run(t)
+        while deadline is not None:
+            deadline = checkExit.run(wakeTime(deadline))
+
+def analyse(params):
+    """ Runs one combination of thresholds. Returns the parameters, counts of what was detected and the time taken. """
+    for name, value in params:
+        if hasattr(sch_app_a, name) and name.isupper():
+            setattr(sch_app_a, name, value)
+        else:
+            config[name] = value
+    sch_app_a.config.update(config)
+    sch_app_a.config["client_test"] = "False"
+    start = time.time()
+    dm = Actions()
+    entryExit = sch_app_a.EntryExit()
+    entryExit.cbLog = cbLog
+    entryExit.dm = dm
+    entryExit.initExits(names)
+    runExits(entryExit)
+    nightWander = sch_app_a.NightWander("AID0")
+    nightWander.cbLog = cbLog
+    nightWander.setNames(names)
+    alarms = nightWander.alarms(events)
+    counts = dict((a, 0) for a in ACTIONS)
+    for location, t, action in dm.actions:
+        counts[action] += 1
+    counts["night_alarms"] = len(alarms)
+    return params, counts, time.time() - start
+
+def parseValue(value):
+    try:
+        return json.loads(value)
+    except ValueError:
+        return value
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Re-run entry/exit and night wandering detection over recorded traces")
+    parser.add_argument("traces", nargs="+")
+    parser.add_argument("--set", action="append", default=[], metavar="KEY=VALUE",
+        help="override an sch_app.config value. The value is parsed as JSON if possible")
+    parser.add_argument("--sweep", action="append", default=[], metavar="NAME=V1,V2,...",
+        help="values to try for a threshold, an entry/exit constant or a config key")
+    parser.add_argument("--workers", type=int, default=multiprocessing.cpu_count(),
+        help="processes to run a sweep in, default one per core")
+    args = parser.parse_args(argv[1:])
+    overrides = {}
+    for s in args.set:
+        key, value = s.split("=", 1)
+        overrides[key] = parseValue(value)
+    sweeps = []
+    for s in args.sweep:
+        name, values = s.split("=", 1)
+        sweeps.append([(name, parseValue(v)) for v in values.split(",")])
+    start = time.time()
+    load(args.traces, overrides)
+    loadTime = time.time() - start
+    out = sys.stdout
+    out.write("Loaded %d binary sensor events from %d traces in %.2f s\n" % (len(events), len(args.traces), loadTime))
+    if not events:
+        return
+    out.write("Covering %s to %s\n" % (time.ctime(events[0][0]), time.ctime(events[-1][0])))
+    combinations = [list(c) for c in itertools.product(*sweeps)]
+    start = time.time()
+    if len(combinations) > 1 and args.workers > 1:
+        if "fork" in multiprocessing.get_all_start_methods():
+            # The workers are forked after the traces are loaded, so they are not read again
+            pool = multiprocessing.get_context("fork").Pool(args.workers)
+        else:
+            pool = multiprocessing.Pool(args.workers, load, (args.traces, overrides))
+        results = pool.map(analyse, combinations)
+        pool.close()
+    else:
+        results = [analyse(c) for c in combinations]
+    elapsed = time.time() - start
+    columns = [s[0][0] for s in sweeps] + list(ACTIONS) + ["night_alarms", "events/s"]
+    out.write(" ".join("%14s" % c[:14] for c in columns) + "\n")
+    for params, counts, duration in results:
+        row = ["%14s" % v for n, v in params] + ["%14d" % counts[c] for c in ACTIONS + ("night_alarms",)]
+        row.append("%14.0f" % (len(events)/duration))
+        out.write(" ".join(row) + "\n")
+    out.write("%d combinations in %.2f s: %.0f events/s in total\n" % (len(results), elapsed, len(events)*len(results)/elapsed))
+
+if __name__ == '__main__':
+    main(sys.argv)
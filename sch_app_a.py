@@ -12,9 +12,22 @@ import os.path
 import time
 from cbcommslib import CbApp
 from cbconfig import *
-import requests
 import json
+import collections
+import random
+from array import array
+import sqlite3
+import zlib
+import math
+import heapq
+import bisect
+import base64
+from io import BytesIO
 from twisted.internet import reactor
+from twisted.python.threadable import isInIOThread
+from twisted.web import server, resource
+from twisted.web.client import Agent, HTTPConnectionPool, FileBodyProducer, readBody
+from twisted.web.http_headers import Headers
 import smtplib
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
@@ -24,16 +37,27 @@ IN_PIR_TO_DOOR_TIME               = 30
 DOOR_CLOSE_TO_IN_PIR_TIME         = 10
 DOOR_OPEN_TO_IN_PIR_TIME          = 15
 MAX_DOOR_OPEN_TIME                = 60
+DEADLINE_MARGIN                   = 0.05  # Time after a deadline that the state machine is run
 
 SEND_DELAY               = 20  # Time to gather values for a device before sending them
+COMPRESSION_MAX_INTERVAL = 3600  # Longest time swinging-door compression will go without sending a point
+ROLLUP_GRACE             = 10  # Time after the end of a rollup window to wait for late values before sending it
+UPLOAD_TIMEOUT           = 60  # Time allowed for a post, including connecting
+TIMER_WHEEL_SLOTS        = 512
+SPOOL_LOW_WATER          = 0.8  # When the spool is full, the oldest posts are dropped until it is this fraction of spool_max_bytes
+TRACE_OMITTED            = ("geras_key",)  # Config values not written to trace files, which are copied to other machines
+UNAVAILABLE              = (0, 408, 429, 502, 503, 504)  # Post statuses that say nothing about the values posted
+LATENCY_BUCKETS          = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300, 600, 1800, 3600)
 # Default values:
 config = {
     "temperature": "True",
     "temp_min_change": 0.2,
+    "temp_compression": "deadband",
     "irtemperature": "False",
     "irtemp_min_change": 0.5,
     "humidity": "True",
     "humidity_min_change": 0.2,
+    "humidity_compression": "deadband",
     "buttons": "False",
     "accel": "False",
     "accel_min_change": 0.02,
@@ -44,422 +68,1769 @@ config = {
     "magnet": "False",
     "magnet_min_change": 1.5,
     "magnet_polling_interval": 3.0,
+    "motion_block_size": 16,
+    "motion_stats": "False",
     "binary": "True",
     "luminance": "True",
     "luminance_min_change": 1.0,
+    "luminance_compression": "deadband",
     "power": "True",
     "power_min_change": 1.0,
+    "power_compression": "deadband",
     "battery": "True",
     "battery_min_change": 1.0,
+    "battery_compression": "deadband",
     "connected": "True",
+    "rollups": {},
+    "rollup_only": [],
     "slow_polling_interval": 600.0,
     "night_wandering": "False",
     "night_start": "00:30",
     "night_end": "07:00",
     "night_sensors": [],
     "night_ignore_time": 600,
+    "pillbox": "False",
+    "pillbox_start": [],
+    "pillbox_end": [],
+    "pillbox_sensors": {},
+    "pillbox_window": 16,
+    "pillbox_threshold": 4.0,
+    "pillbox_min_change": 1.5,
+    "pillbox_hold_off": 60,
     "entry-exit": "False",
     "entry-exits": [],
     "cid": "none",
     "client_test": "False",
+    "client_window": 8,
+    "client_retry_interval": 10,
+    "client_retry_max_delay": 300,
+    "client_max_messages": 100,
+    "client_max_attempts": 12,
+    "timer_resolution": 0.25,
+    "timer_report_interval": 600,
+    "upload_workers": 2,
+    "event_workers": 1,
+    "batch_upload": "False",
+    "batch_max_values": 500,
+    "adaptive_batching": "False",
+    "batch_min_delay": 1,
+    "batch_max_delay": 60,
+    "batch_max_post_rate": 1,
+    "batch_rate_window": 60,
+    "spool_max_bytes": 20000000,
+    "spool_drain_interval": 2,
+    "spool_max_attempts": 5,
+    "upload_encoding": "senml",
+    "upload_gzip": "False",
+    "breaker_threshold": 3,
+    "retry_max_delay": 600,
+    "upload_report_interval": 600,
+    "metrics_interval": 600,
+    "metrics_port": 0,
+    "trace_file": "",
+    "history": "False",
+    "history_hours": 24,
+    "history_max_values": 5000,
+    "series_url": "http://geras.1248.io/series/",
     "geras_key": "undefined"
 }
 
-def betweenTimes(t, t1, t2):
-    # True if epoch t is between times of day t1 and t2 (in 24-hour clock format: "23:10")
-    t1secs = (60*int(t1.split(":")[0]) + int(t1.split(":")[1])) * 60
-    t2secs = (60*int(t2.split(":")[0]) + int(t2.split(":")[1])) * 60
-    stamp = time.strftime("%Y %b %d %H:%M", time.localtime(t)).split()
-    today = stamp
-    today[3] = "00:00"
-    today_e = time.mktime(time.strptime(" ".join(today), "%Y %b %d %H:%M"))
-    yesterday_e = today_e - 24*3600
-    #print "today_e: ", today_e, "yesterday_e: ", yesterday_e
-    tt1 = [yesterday_e + t1secs, today_e + t1secs]
-    tt2 = [yesterday_e + t2secs, today_e + t2secs]
-    #print "tt1: ", tt1, " tt2: ", tt2
-    smallest = 50000
-    decision = False
-    if t - tt1[0] < smallest and t - tt1[0] > 0:
-        smallest = t - tt1[0]
-        decision = True
-    if t - tt2[0] < smallest and t -tt2[0] > 0:
-        smallest = t - tt2[0]
-        decision = False
-    if t - tt1[1] < smallest and t -tt1[1] > 0:
-        smallest = t - tt1[1]
-        decision = True
-    if t - tt2[1] < smallest and t - tt2[1] > 0:
-        smallest = t - tt2[1]
-        decision = False
-    return decision
+class Clock():
+    """ The time that the app runs on. Wall time, with calls scheduled on the reactor. """
+    def time(self):
+        return time.time()
+
+    def callLater(self, delay, f, *args):
+        return reactor.callLater(delay, f, *args)
+
+    def isInIOThread(self):
+        return isInIOThread()
+
+    def callFromThread(self, f, *args):
+        reactor.callFromThread(f, *args)
+
+class SimulatedCall():
+    """ A call scheduled on a SimulatedClock. Has the methods of a Twisted DelayedCall that the app uses. """
+    def __init__(self, when, f, args):
+        self.when = when
+        self.f = f
+        self.args = args
+        self.called = False
+        self.cancelled = False
+
+    def active(self):
+        return not (self.called or self.cancelled)
+
+    def cancel(self):
+        self.cancelled = True
+
+class SimulatedClock():
+    """
+    A clock that only moves on when advance is called, so that the app can be run
+    over recorded data much faster than real time, eg. by sch_replay.py --simulate.
+    Calls that fall due are made in time order, each at its own time.
+    """
+    def __init__(self, now):
+        self.now = now
+        self.calls = []     # heap of (when, sequence, SimulatedCall)
+        self.sequence = 0
+
+    def time(self):
+        return self.now
+
+    def isInIOThread(self):
+        # Everything runs in the thread that advances the clock
+        return True
+
+    def callFromThread(self, f, *args):
+        self.callLater(0, f, *args)
+
+    def callLater(self, delay, f, *args):
+        call = SimulatedCall(self.now + max(0, delay), f, args)
+        self.sequence += 1
+        heapq.heappush(self.calls, (call.when, self.sequence, call))
+        return call
+
+    def advance(self, to):
+        while self.calls and self.calls[0][0] <= to:
+            when, sequence, call = heapq.heappop(self.calls)
+            if call.active():
+                self.now = max(self.now, when)
+                call.called = True
+                call.f(*call.args)
+        self.now = max(self.now, to)
+
+clock = Clock()
+
+class Timer():
+    """ A deadline registered with the TimerWheel. Has the same methods as a Twisted DelayedCall. """
+    def __init__(self, f, args):
+        self.f = f
+        self.args = args
+        self.deadline = 0
+        self.tick = 0
+        self.slot = None
+
+    def active(self):
+        return self.slot is not None
+
+    def cancel(self):
+        timers.cancel(self)
+
+    def reset(self, delay):
+        timers.cancel(self)
+        timers.add(self, delay)
+
+class TimerWheel():
+    """
+    A hashed timer wheel that all of the app's timers are registered with. Deadlines
+    are rounded up to the next multiple of timer_resolution, and all timers due in
+    the same tick are run from one reactor call. There is no reactor call at all
+    while no timers are pending.
+    """
+    def __init__(self, resolution):
+        self.resolution = resolution
+        self.slots = [set() for i in range(TIMER_WHEEL_SLOTS)]
+        self.tick = int(clock.time() / resolution)
+        self.reactorCall = None
+        self.nextTick = None
+        self.pending = 0
+        self.scheduled = 0
+        self.fired = 0
+        self.cancelled = 0
+        self.reactorCalls = 0
+
+    def setResolution(self, resolution):
+        pending = [timer for slot in self.slots for timer in slot]
+        for slot in self.slots:
+            slot.clear()
+        self.resolution = resolution
+        self.tick = int(clock.time() / resolution)
+        self.nextTick = None
+        for timer in pending:
+            self.insert(timer)
+
+    def callLater(self, delay, f, *args):
+        timer = Timer(f, args)
+        self.add(timer, delay)
+        self.scheduled += 1
+        return timer
+
+    def add(self, timer, delay):
+        timer.deadline = clock.time() + delay
+        self.insert(timer)
+        self.pending += 1
+
+    def insert(self, timer):
+        # Round up, so that a timer never runs before its deadline
+        timer.tick = max(int(math.ceil(timer.deadline / self.resolution)), self.tick)
+        timer.slot = self.slots[timer.tick % TIMER_WHEEL_SLOTS]
+        timer.slot.add(timer)
+        if self.nextTick is None or timer.tick < self.nextTick:
+            self.schedule(timer.tick)
+
+    def cancel(self, timer):
+        if timer.slot is not None:
+            timer.slot.discard(timer)
+            timer.slot = None
+            self.pending -= 1
+            self.cancelled += 1
+
+    def schedule(self, tick):
+        self.nextTick = tick
+        if self.reactorCall and self.reactorCall.active():
+            self.reactorCall.cancel()
+        self.reactorCall = clock.callLater(max(0, self.nextTick * self.resolution - clock.time()), self.run)
+
+    def run(self):
+        self.reactorCalls += 1
+        due = []
+        self.reactorCall = None
+        self.nextTick = None
+        now = int(clock.time() / self.resolution)
+        for tick in range(self.tick, min(now + 1, self.tick + TIMER_WHEEL_SLOTS)):
+            slot = self.slots[tick % TIMER_WHEEL_SLOTS]
+            for timer in [timer for timer in slot if timer.tick <= now]:
+                slot.discard(timer)
+                timer.slot = None
+                due.append(timer)
+        self.tick = now + 1
+        self.pending -= len(due)
+        self.findNext()
+        due.sort(key=lambda timer: timer.deadline)
+        for timer in due:
+            self.fired += 1
+            try:
+                timer.f(*timer.args)
+            except Exception as ex:
+                self.cbLog("warning", "Timer " + str(timer.f) + " raised exception: " + str(type(ex)) + str(ex.args))
+
+    def findNext(self):
+        if self.pending == 0:
+            return
+        for tick in range(self.tick, self.tick + TIMER_WHEEL_SLOTS):
+            for timer in self.slots[tick % TIMER_WHEEL_SLOTS]:
+                if timer.tick == tick:
+                    self.schedule(tick)
+                    return
+        # Nothing due within one turn of the wheel
+        self.schedule(min(timer.tick for slot in self.slots for timer in slot))
+
+    def getStats(self):
+        return {"pending": self.pending,
+                "scheduled": self.scheduled,
+                "fired": self.fired,
+                "cancelled": self.cancelled,
+                "reactor_calls": self.reactorCalls}
+
+    def report(self):
+        self.cbLog("info", "Timers: " + str(self.getStats()))
+        self.callLater(config["timer_report_interval"], self.report)
+
+timers = TimerWheel(config["timer_resolution"])
+
+def useClock(c):
+    """ Runs the app on clock c, eg. a SimulatedClock, in place of wall time. Must be called before any timers are set. """
+    global clock
+    clock = c
+    timers.setResolution(timers.resolution)
+
+class Histogram():
+    """ Counts values in fixed buckets. Percentiles are estimated as the upper bound of a bucket. """
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.buckets = [0]*(len(bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, v):
+        self.buckets[bisect.bisect_left(self.bounds, v)] += 1
+        self.count += 1
+        self.total += v
+        if v > self.max:
+            self.max = v
+
+    def percentile(self, p):
+        target = p*self.count
+        seen = 0
+        for i in range(len(self.bounds)):
+            seen += self.buckets[i]
+            if seen >= target:
+                return min(self.bounds[i], round(self.max, 3))
+        return round(self.max, 3)
+
+    def getStats(self):
+        if self.count == 0:
+            return {"count": 0}
+        return {"count": self.count,
+                "mean": round(self.total/self.count, 3),
+                "p50": self.percentile(0.5),
+                "p95": self.percentile(0.95),
+                "max": round(self.max, 3),
+                "buckets": dict(zip([str(b) for b in self.bounds] + ["inf"], self.buckets))}
+
+class Metrics():
+    """
+    Counters and histograms that are cheap enough to update on every message. Counters
+    are grouped, eg. messages per characteristic. Sources are functions that are only
+    called when the metrics are read, for values such as queue depths. All values are
+    totals since the app started.
+    """
+    def __init__(self):
+        self.start = time.time()
+        self.counters = {}
+        self.histograms = {}
+        self.sources = {}
+
+    def count(self, group, key, n=1):
+        try:
+            self.counters[group][key] += n
+        except KeyError:
+            self.counters.setdefault(group, {}).setdefault(key, 0)
+            self.counters[group][key] += n
+
+    def observe(self, name, v):
+        if not name in self.histograms:
+            self.histograms[name] = Histogram(LATENCY_BUCKETS)
+        self.histograms[name].add(v)
+
+    def addSource(self, name, f):
+        self.sources[name] = f
+
+    def getStats(self):
+        stats = {"uptime": round(time.time() - self.start),
+                 "counters": self.counters,
+                 "histograms": dict((name, self.histograms[name].getStats()) for name in self.histograms)}
+        for name in self.sources:
+            try:
+                stats[name] = self.sources[name]()
+            except Exception as ex:
+                stats[name] = "error: " + str(type(ex)) + str(ex.args)
+        return stats
+
+metrics = Metrics()
+metrics.addSource("timers", timers.getStats)
+
+class MetricsResource(resource.Resource):
+    """ Serves the metrics as JSON on metrics_port, and recent history under /history """
+    def getChild(self, path, request):
+        if path == b"history":
+            return HistoryResource()
+        return self
+
+    def render_GET(self, request):
+        request.setHeader("Content-Type", "application/json")
+        return json.dumps(metrics.getStats()).encode("utf-8")
+
+class TimeWindow():
+    """
+    A window between two times of day in 24-hour clock format ("23:10"), which
+    may cross midnight. The epochs of the current day's boundaries are cached,
+    so they are only recalculated when a time falls on a different local day.
+    """
+    def __init__(self, start, end):
+        self.startHM = (int(start.split(":")[0]), int(start.split(":")[1]))
+        self.endHM = (int(end.split(":")[0]), int(end.split(":")[1]))
+        self.crossesMidnight = self.endHM < self.startHM
+        self.dayStart = 0
+        self.dayEnd = 0
+
+    def refresh(self, t):
+        # mktime with tm_isdst -1 takes care of DST changes and of day 32 etc.
+        lt = time.localtime(t)
+        self.dayStart = time.mktime((lt.tm_year, lt.tm_mon, lt.tm_mday, 0, 0, 0, 0, 0, -1))
+        self.dayEnd = time.mktime((lt.tm_year, lt.tm_mon, lt.tm_mday + 1, 0, 0, 0, 0, 0, -1))
+        self.start = time.mktime((lt.tm_year, lt.tm_mon, lt.tm_mday, self.startHM[0], self.startHM[1], 0, 0, 0, -1))
+        self.end = time.mktime((lt.tm_year, lt.tm_mon, lt.tm_mday, self.endHM[0], self.endHM[1], 0, 0, 0, -1))
+
+    def contains(self, t):
+        if t < self.dayStart or t >= self.dayEnd:
+            self.refresh(t)
+        if self.crossesMidnight:
+            return t >= self.start or t < self.end
+        else:
+            return self.start <= t < self.end
+
+    def containsMany(self, times):
+        """ For offline analysis. Fastest if times are in order. """
+        return [self.contains(t) for t in times]
+
+    def nextEnd(self, t):
+        """ Returns the first end of the window after t """
+        self.refresh(t)
+        if t < self.end:
+            return self.end
+        lt = time.localtime(t)
+        return time.mktime((lt.tm_year, lt.tm_mon, lt.tm_mday + 1, self.endHM[0], self.endHM[1], 0, 0, 0, -1))
+
+def encodeValues(values):
+    """
+    Returns the JSON body for a post of values. With upload_encoding set to
+    senml_base, names and timestamps are sent relative to SenML bn and bt fields.
+    """
+    if config["upload_encoding"] != "senml_base" or not values:
+        return json.dumps({"e": values})
+    bt = min(v["t"] for v in values)
+    bn = os.path.commonprefix([v["n"] for v in values])
+    bn = bn[:bn.rfind("/")+1]
+    skip = len(bn)
+    e = [{"n":v["n"][skip:], "v":v["v"], "t":round(v["t"] - bt, 3)} for v in values]
+    if bn:
+        return json.dumps({"bn": bn, "bt": bt, "e": e}, separators=(",", ":"))
+    else:
+        return json.dumps({"bt": bt, "e": e}, separators=(",", ":"))
+
+def succeeded(status):
+    return 200 <= status < 300
+
+def retryable(status):
+    """ True if a post that failed with status may succeed if it is sent again. Status 0 is no response. """
+    return status == 0 or status >= 500 or status in (408, 429)
+
+class CircuitBreaker():
+    """
+    Tracks failed posts to one endpoint. Resends of failed posts always back off
+    exponentially, with jitter. Once breaker_threshold posts in a row have failed the
+    breaker opens and new posts are not attempted either, until a single trial post
+    after the back-off time succeeds. Only failures that may succeed if the post is
+    sent again count; a post rejected for its contents, eg. with 400, does not.
+    """
+    def __init__(self, endpoint):
+        self.endpoint = endpoint
+        self.failures = 0
+        self.retryAt = 0
+        self.trial = False
+
+    def isOpen(self):
+        return self.failures >= config["breaker_threshold"]
+
+    def allow(self, retry=False):
+        if not retry and not self.isOpen():
+            return True
+        if self.trial or clock.time() < self.retryAt:
+            return False
+        self.trial = True
+        return True
+
+    def retryDelay(self):
+        return max(0, self.retryAt - clock.time())
+
+    def onResult(self, status):
+        self.trial = False
+        if succeeded(status):
+            if self.isOpen():
+                self.cbLog("info", "Circuit breaker closed for " + self.endpoint)
+            self.failures = 0
+            self.retryAt = 0
+        elif retryable(status):
+            self.failures += 1
+            delay = min(config["retry_max_delay"], SEND_DELAY * 2**min(self.failures - 1, 16))
+            self.retryAt = clock.time() + random.uniform(delay/2, delay)
+            if self.failures == config["breaker_threshold"]:
+                self.cbLog("warning", "Circuit breaker opened for " + self.endpoint)
+
+class Uploader():
+    """
+    Posts values to the database from the reactor thread, using Twisted's HTTP Agent
+    over a pool of persistent connections, so no threads are taken from the pool
+    that cbcommslib calls onAdaptorData on. Posts are made on two lanes. Events have
+    their own queue and event_workers connections, so they never wait behind bulk
+    values, of which at most "workers" posts are in progress.
+    """
+    def __init__(self, workers):
+        self.workers = workers
+        self.active = 0
+        self.eventActive = 0
+        self.queue = collections.deque()
+        self.eventQueue = collections.deque()
+        self.pool = HTTPConnectionPool(reactor, persistent=True)
+        self.pool.maxPersistentPerHost = workers + config["event_workers"]
+        self.agent = Agent(reactor, connectTimeout=UPLOAD_TIMEOUT, pool=self.pool)
+        auth = base64.b64encode((config["geras_key"] + ":").encode("utf-8"))
+        self.headers = {b"Content-Type": [b"application/json"], b"Authorization": [b"Basic " + auth]}
+        self.gzipHeaders = dict(self.headers)
+        self.gzipHeaders[b"Content-Encoding"] = [b"gzip"]
+        self.breakers = {}
+        self.plainEndpoints = set()  # endpoints that have refused gzip bodies
+        self.resetStats()
+        timers.callLater(config["upload_report_interval"], self.report)
+        reactor.addSystemEventTrigger("before", "shutdown", self.pool.closeCachedConnections)
+
+    def resetStats(self):
+        self.posts = 0
+        self.failures = 0
+        self.bytesSent = 0
+        self.postTime = 0.0
+        self.statsStart = time.time()
+
+    def breaker(self, endpoint):
+        if not endpoint in self.breakers:
+            self.breakers[endpoint] = CircuitBreaker(endpoint)
+            self.breakers[endpoint].cbLog = self.cbLog
+        return self.breakers[endpoint]
+
+    def allow(self, endpoint, retry=False):
+        return self.breaker(endpoint).allow(retry)
+
+    def post(self, endpoint, url, body, onDone, lane="bulk"):
+        """ onDone(status) is called in the reactor thread. status is 0 if the post failed without a response. """
+        if lane == "event":
+            self.eventQueue.append((endpoint, url, body, onDone))
+        else:
+            self.queue.append((endpoint, url, body, onDone))
+        self.pump()
+
+    def pump(self):
+        while self.eventActive < config["event_workers"] and self.eventQueue:
+            endpoint, url, body, onDone = self.eventQueue.popleft()
+            self.active += 1
+            self.eventActive += 1
+            self.send(endpoint, url, body, onDone, "event")
+        while self.active - self.eventActive < self.workers and self.queue:
+            endpoint, url, body, onDone = self.queue.popleft()
+            self.active += 1
+            self.send(endpoint, url, body, onDone, "bulk")
+
+    def request(self, url, body, headers):
+        """ Returns a Deferred that fires with the status. The response is read so the connection can be reused. """
+        d = self.agent.request(b"POST", url.encode("utf-8"), Headers(headers), FileBodyProducer(BytesIO(body)))
+        d.addCallback(lambda response: readBody(response).addCallback(lambda ignored: response.code))
+        d.addTimeout(UPLOAD_TIMEOUT, reactor)
+        return d
+
+    def send(self, endpoint, url, body, onDone, lane):
+        start = time.time()
+        body = body.encode("utf-8")
+        def done(status, size):
+            self.postDone(endpoint, size, status, time.time() - start, onDone, lane)
+        def failed(failure):
+            self.cbLog("warning", "Uploader post failed: " + str(failure.type) + " " + failure.getErrorMessage())
+            done(0, len(body))
+        def sendPlain():
+            self.request(url, body, self.headers).addCallbacks(done, failed, callbackArgs=(len(body),))
+        def plainDone(status):
+            if succeeded(status):
+                # The body was good, so it was the gzip encoding that was refused
+                self.cbLog("info", "Uploader: gzip refused by " + endpoint + ", status: 400")
+                self.plainEndpoints.add(endpoint)
+            done(status, len(body))
+        def zippedDone(status):
+            if status == 415:
+                # The server does not accept gzip, so fall back to plain bodies for this endpoint
+                self.cbLog("info", "Uploader: gzip refused by " + endpoint + ", status: " + str(status))
+                self.plainEndpoints.add(endpoint)
+                sendPlain()
+            elif status == 400:
+                # Some servers refuse gzip with 400, but a bad body gets 400 too. Only a plain resend can tell which.
+                self.request(url, body, self.headers).addCallbacks(plainDone, failed)
+            else:
+                done(status, len(zipped))
+        if config["upload_gzip"] == "True" and endpoint not in self.plainEndpoints:
+            compressor = zlib.compressobj(6, zlib.DEFLATED, 31)  # 31: gzip format
+            zipped = compressor.compress(body) + compressor.flush()
+            self.request(url, zipped, self.gzipHeaders).addCallbacks(zippedDone, failed)
+        else:
+            sendPlain()
+
+    def postDone(self, endpoint, size, status, duration, onDone, lane):
+        self.active -= 1
+        if lane == "event":
+            self.eventActive -= 1
+        self.breaker(endpoint).onResult(status)
+        metrics.count("upload_status", str(status))
+        metrics.observe("post_time", duration)
+        self.posts += 1
+        self.postTime += duration
+        if succeeded(status):
+            self.bytesSent += size
+        else:
+            self.failures += 1
+        onDone(status)
+        self.pump()
+
+    def report(self):
+        elapsed = time.time() - self.statsStart
+        if self.posts > 0:
+            self.cbLog("info", "Uploader: " + str(self.posts) + " posts, " + str(self.failures) + " failed, " + \
+                "%.2f posts/s, %.2f kB/s, mean post time %.2f s, queued: %d" % \
+                (self.posts/elapsed, self.bytesSent/elapsed/1024, self.postTime/self.posts, len(self.queue)))
+        self.resetStats()
+        timers.callLater(config["upload_report_interval"], self.report)
+
+class Spool():
+    """
+    Keeps values from posts that failed in an SQLite file in CB_CONFIG_DIR, so that
+    they survive restarts and do not build up in memory. They are sent again oldest
+    first, one post at a time, as each endpoint's circuit breaker allows, with posts
+    from the event lane before the rest. A post the
+    database rejects, or that gets a server error spool_max_attempts times, is dropped
+    so that it does not hold up the posts behind it.
+    """
+    def __init__(self, fileName):
+        self.db = sqlite3.connect(fileName)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS spool (id INTEGER PRIMARY KEY AUTOINCREMENT, " + \
+            "endpoint TEXT, url TEXT, n INTEGER, vals TEXT, attempts INTEGER DEFAULT 0, lane TEXT DEFAULT 'bulk')")
+        self.addColumn("attempts", "INTEGER DEFAULT 0")
+        self.addColumn("lane", "TEXT DEFAULT 'bulk'")
+        self.db.execute("CREATE INDEX IF NOT EXISTS spool_endpoint ON spool (endpoint, id)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS spool_lane ON spool (endpoint, lane, id)")
+        self.db.commit()
+        self.endpoints = {}  # endpoint -> number of rows spooled for it
+        for endpoint, count in self.db.execute("SELECT endpoint, COUNT(*) FROM spool GROUP BY endpoint"):
+            self.endpoints[endpoint] = count
+        self.count, self.size = self.db.execute("SELECT COUNT(*), IFNULL(SUM(LENGTH(vals)), 0) FROM spool").fetchone()
+        self.inFlight = None
+        self.drainTimer = timers.callLater(SEND_DELAY, self.drain)
+
+    def addColumn(self, name, definition):
+        """ For spool files written by earlier versions """
+        if not name in [c[1] for c in self.db.execute("PRAGMA table_info(spool)")]:
+            self.db.execute("ALTER TABLE spool ADD COLUMN " + name + " " + definition)
+
+    def append(self, endpoint, url, values, lane="bulk"):
+        # Merge into the newest row for this url and lane if the result stays within a batch
+        row = self.db.execute("SELECT id, url, n, vals, lane FROM spool WHERE endpoint = ? ORDER BY id DESC LIMIT 1", \
+            (endpoint,)).fetchone()
+        if row and row[0] != self.inFlight and row[1] == url and row[4] == lane and \
+                row[2] + len(values) <= config["batch_max_values"]:
+            vals = json.dumps(json.loads(row[3]) + values)
+            self.db.execute("UPDATE spool SET n = ?, vals = ? WHERE id = ?", (row[2] + len(values), vals, row[0]))
+            self.size += len(vals) - len(row[3])
+        else:
+            vals = json.dumps(values)
+            self.db.execute("INSERT INTO spool (endpoint, url, n, vals, lane) VALUES (?, ?, ?, ?, ?)", \
+                (endpoint, url, len(values), vals, lane))
+            self.count += 1
+            self.size += len(vals)
+            self.endpoints[endpoint] = self.endpoints.get(endpoint, 0) + 1
+        self.db.commit()
+        if self.size > config["spool_max_bytes"]:
+            self.trim()
+        if not self.inFlight and not self.drainTimer:
+            self.scheduleDrain(self.uploader.breaker(endpoint).retryDelay())
+
+    def remove(self, rowID, endpoint):
+        """ Returns False if the row has already gone """
+        row = self.db.execute("SELECT LENGTH(vals) FROM spool WHERE id = ?", (rowID,)).fetchone()
+        if not row:
+            return False
+        self.db.execute("DELETE FROM spool WHERE id = ?", (rowID,))
+        self.count -= 1
+        self.size -= row[0]
+        self.endpoints[endpoint] -= 1
+        return True
+
+    def trim(self):
+        """ Drops the oldest posts down to a low-water mark, so that the next append does not trim again """
+        excess = self.size - SPOOL_LOW_WATER*config["spool_max_bytes"]
+        last = None
+        for rowID, size in self.db.execute("SELECT id, LENGTH(vals) FROM spool ORDER BY id"):
+            if excess <= 0:
+                break
+            last = rowID
+            excess -= size
+        newest = self.db.execute("SELECT MAX(id) FROM spool").fetchone()[0]
+        if last is None or last == newest:
+            # Always keep the newest post
+            last = self.db.execute("SELECT MAX(id) FROM spool WHERE id < ?", (newest,)).fetchone()[0]
+            if last is None:
+                return
+        dropped = 0
+        for endpoint, count, size in self.db.execute("SELECT endpoint, COUNT(*), SUM(LENGTH(vals)) FROM spool " + \
+                "WHERE id <= ? GROUP BY endpoint", (last,)).fetchall():
+            self.endpoints[endpoint] -= count
+            self.count -= count
+            self.size -= size
+            dropped += count
+        self.db.execute("DELETE FROM spool WHERE id <= ?", (last,))
+        self.db.commit()
+        self.cbLog("warning", "Spool full. Dropped " + str(dropped) + " oldest posts")
+
+    def compact(self):
+        self.db.execute("VACUUM")
+        self.db.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+
+    def scheduleDrain(self, delay):
+        self.drainTimer = timers.callLater(delay, self.drain)
+
+    def wake(self, endpoint):
+        """ Called when a post has succeeded, so that anything spooled is sent without waiting. """
+        if self.endpoints.get(endpoint, 0) > 0 and not self.inFlight:
+            if self.drainTimer and self.drainTimer.active():
+                self.drainTimer.cancel()
+            self.drain()
+
+    def drain(self):
+        self.drainTimer = None
+        row = None
+        wait = config["retry_max_delay"]
+        for endpoint in self.endpoints:
+            if self.endpoints[endpoint] > 0:
+                if self.uploader.allow(endpoint, retry=True):
+                    row = self.db.execute("SELECT id, url, vals, attempts, lane FROM spool WHERE endpoint = ? " + \
+                        "AND lane = 'event' ORDER BY id LIMIT 1", (endpoint,)).fetchone() or \
+                        self.db.execute("SELECT id, url, vals, attempts, lane FROM spool WHERE endpoint = ? " + \
+                        "ORDER BY id LIMIT 1", (endpoint,)).fetchone()
+                    break
+                wait = min(wait, self.uploader.breaker(endpoint).retryDelay())
+        if not row:
+            if self.count > 0:
+                self.scheduleDrain(max(wait, config["spool_drain_interval"]))
+            return
+        rowID, url, vals, attempts, lane = row
+        values = json.loads(vals)
+        self.inFlight = rowID
+        metrics.count("upload_retries", endpoint)
+        def onDone(status):
+            self.inFlight = None
+            if succeeded(status):
+                metrics.observe("upload_latency_spooled", clock.time() - min(v["t"] for v in values))
+                # The row may already have been dropped by trim while it was being posted
+                self.remove(rowID, endpoint)
+                self.db.commit()
+                if self.count == 0:
+                    self.cbLog("info", "Spool drained")
+                    self.compact()
+                self.scheduleDrain(config["spool_drain_interval"])
+            elif not retryable(status):
+                self.cbLog("warning", "Spool: dropped a post of " + str(len(values)) + " values rejected by " + \
+                    endpoint + ", status: " + str(status))
+                self.dropRow(rowID, endpoint)
+            elif not status in UNAVAILABLE:
+                # A server error may be caused by the values, so they are only tried so many times
+                if attempts + 1 >= config["spool_max_attempts"]:
+                    self.cbLog("warning", "Spool: dropped a post of " + str(len(values)) + " values after " + \
+                        str(attempts + 1) + " attempts to " + endpoint + ", status: " + str(status))
+                    self.dropRow(rowID, endpoint)
+                else:
+                    self.db.execute("UPDATE spool SET attempts = ? WHERE id = ?", (attempts + 1, rowID))
+                    self.db.commit()
+                    self.drain()
+            else:
+                self.drain()
+        self.uploader.post(endpoint, url, encodeValues(values), onDone, lane)
+
+    def dropRow(self, rowID, endpoint):
+        self.remove(rowID, endpoint)
+        self.db.commit()
+        metrics.count("spool_dropped", endpoint)
+        self.scheduleDrain(config["spool_drain_interval"])
+
+class FlushController():
+    """
+    Picks how long to gather values before posting them, from the rate at which they
+    arrive. Rates are exponentially weighted over batch_rate_window seconds, for each
+    url and in total. Posts are limited to batch_max_post_rate a second by sharing the
+    rate out between urls so that each takes no more than it needs (water-filling):
+    a url that gets fewer values than its share is posted after batch_min_delay, a
+    busy one waits until a post a share is due. No value waits more than batch_max_delay.
+    """
+    def __init__(self):
+        self.rates = {}     # url -> [rate, time of last update]
+        self.total = [0.0, 0.0]
+        self.level = None   # share of the post rate for each url, None if there is no limit
+        self.planned = 0
+
+    def decayed(self, r, now):
+        return r[0]*math.exp((r[1] - now)/config["batch_rate_window"])
+
+    def arrived(self, url, n=1):
+        now = clock.time()
+        if not url in self.rates:
+            self.rates[url] = [0.0, now]
+        for r in (self.rates[url], self.total):
+            r[0] = self.decayed(r, now) + float(n)/config["batch_rate_window"]
+            r[1] = now
+
+    def plan(self, now):
+        """ Works out each url's share of the post rate. Done at most once a second. """
+        self.planned = now
+        budget = float(config["batch_max_post_rate"])
+        rates = sorted(self.decayed(r, now) for r in self.rates.values())
+        self.level = None
+        for i in range(len(rates)):
+            share = budget/(len(rates) - i)
+            if rates[i] > share:
+                self.level = share
+                break
+            budget -= rates[i]
+        # Forget urls that have been quiet for a long time
+        for url in [u for u in self.rates if now - self.rates[u][1] > 10*config["batch_rate_window"]]:
+            del self.rates[url]
+
+    def delay(self, url=None):
+        """ Seconds to wait after the first value for url, or for all urls in batch mode, before posting """
+        now = clock.time()
+        if url is None:
+            rate, share = self.decayed(self.total, now), config["batch_max_post_rate"]
+        else:
+            if now - self.planned >= 1:
+                self.plan(now)
+            rate, share = self.decayed(self.rates[url], now), self.level
+        if share is None or rate <= share:
+            return config["batch_min_delay"]
+        # Posts are made every delay + 1/rate seconds, the time for the first value to arrive
+        return min(config["batch_max_delay"], max(config["batch_min_delay"], 1.0/share - 1.0/rate))
+
+    def getStats(self):
+        now = clock.time()
+        return {"rate": round(self.decayed(self.total, now), 3),
+                "share": self.level and round(self.level, 4),
+                "delay": round(self.delay(), 2)}
 
 class DataManager:
     """ Managers data storage for all sensors """
     def __init__(self, bridge_id):
-        self.baseurl = "http://geras.1248.io/series/" + bridge_id + "/"
-        self.daurl = "http://geras.1248.io/series/" + "DA" + bridge_id[3:] + "/"
-        self.s={}
-        self.waiting=[]
+        if bridge_id:
+            self.baseurl = config["series_url"] + bridge_id + "/"
+            self.daurl = config["series_url"] + "DA" + bridge_id[3:] + "/"
+        else:
+            # Shared by several bridges in gateway mode, which name their series in full (see BridgeData)
+            self.baseurl = config["series_url"]
+            self.daurl = config["series_url"]
+        self.s={}           # url -> {series name: (timestamps, values)} waiting to be posted to it
+        self.waiting=[]     # urls with a send timer running (per-device mode)
+        self.pending = 0    # number of values in self.s
+        self.flushTimer = None
+        self.events = {}    # url -> list of values waiting to be posted on the event lane
+        self.held = {}      # url -> blocks holding readings to be sent with its values (see MotionBlock)
+        self.eventTimer = None
+        self.spool = None
+        self.history = None
+        if config["adaptive_batching"] == "True":
+            self.controller = FlushController()
+            metrics.addSource("batching", self.controller.getStats)
+        else:
+            self.controller = None
+
+    def encode(self, buffers):
+        """ Builds the list of values to post from the buffers for one url. """
+        values = []
+        for name in buffers:
+            times, vals = buffers[name]
+            for i in range(len(times)):
+                values.append({"n":name, "v":vals[i], "t":times[i]})
+        return values
+
+    def sendValues(self, url):
+        for block in self.held.pop(url, ()):
+            block.release()
+        buffers = self.s.pop(url, {})
+        self.waiting.remove(url)
+        values = self.encode(buffers)
+        self.pending -= len(values)
+        if values:
+            self.post(url, values)
+
+    def flush(self):
+        """ Batch mode. Sends the values for all devices in as few posts as possible. """
+        held = self.held
+        self.held = {}
+        for url in held:
+            for block in held[url]:
+                block.release()
+        if self.flushTimer and self.flushTimer.active():
+            self.flushTimer.cancel()
+        self.flushTimer = None
+        batch = self.s
+        self.s = {}
+        self.pending = 0
+        for url in batch:
+            values = self.encode(batch[url])
+            for i in range(0, len(values), config["batch_max_values"]):
+                chunk = values[i:i+config["batch_max_values"]]
+                try:
+                    self.post(url, chunk)
+                except Exception as ex:
+                    # Keep the values, rather than losing the rest of the batch
+                    self.cbLog("warning", "flush could not post to " + url + ", exception: " + str(type(ex)) + str(ex.args))
+                    timers.callLater(SEND_DELAY, self.queueValues, url, chunk)
+
+    def flushEvents(self):
+        self.eventTimer = None
+        events = self.events
+        self.events = {}
+        for url in events:
+            values = events[url]
+            for i in range(0, len(values), config["batch_max_values"]):
+                self.post(url, values[i:i+config["batch_max_values"]], "event")
+
+    def post(self, url, values, lane="bulk"):
+        if url.startswith(self.daurl):
+            endpoint = self.daurl
+        else:
+            endpoint = self.baseurl
+        if not self.uploader.allow(endpoint):
+            # Circuit breaker is open, so don't waste a post that will fail
+            self.storeFailed(endpoint, url, values, lane)
+            return
+        def onDone(status):
+            if succeeded(status):
+                if lane == "event":
+                    # From the newest value, which is the event itself
+                    metrics.observe("upload_latency_event", clock.time() - max(v["t"] for v in values))
+                else:
+                    metrics.observe("upload_latency_bulk", clock.time() - min(v["t"] for v in values))
+                if self.spool:
+                    self.spool.wake(endpoint)
+            elif retryable(status):
+                self.cbLog("debug", "sendValues failed, status: " + str(status))
+                self.storeFailed(endpoint, url, values, lane)
+            else:
+                # Sending the values again would not help
+                self.cbLog("warning", "Post of " + str(len(values)) + " values rejected by " + endpoint + \
+                    ", status: " + str(status) + ". Values dropped")
+                metrics.count("upload_rejected", endpoint, len(values))
+        self.uploader.post(endpoint, url, encodeValues(values), onDone, lane)
+
+    def storeFailed(self, endpoint, url, values, lane="bulk"):
+        # Store the values that weren't sent ready to be sent again, on the same lane
+        if self.spool:
+            self.spool.append(endpoint, url, values, lane)
+        else:
+            timers.callLater(self.uploader.breaker(endpoint).retryDelay(), self.queueValues, url, values, lane == "event")
+            metrics.count("upload_retries", endpoint)
 
-    def sendValuesThread(self, values, deviceID, da):
+    def queueValues(self, url, values, event=False):
+        if event:
+            queue = self.queueEvent
+        else:
+            queue = self.queueValue
+        for v in values:
+            queue(url, v["n"], v["t"], v["v"])
+
+    def queueEvent(self, url, name, timeStamp, value):
+        """ Events are posted on the next timer tick, on the event lane """
+        if not url in self.events:
+            self.events[url] = []
+        self.events[url].append({"n":name, "v":value, "t":timeStamp})
+        if not self.eventTimer:
+            self.eventTimer = timers.callLater(0, self.flushEvents)
+
+    def queueValue(self, url, name, timeStamp, value):
+        if not url in self.s:
+            self.s[url] = {}
+        if not name in self.s[url]:
+            self.s[url][name] = (array("d"), array("d"))
+        times, vals = self.s[url][name]
+        times.append(timeStamp)
+        vals.append(value)
+        self.pending += 1
+        if self.controller:
+            self.controller.arrived(url)
+        if config["batch_upload"] == "True" and self.pending >= config["batch_max_values"]:
+            self.flush()
+        else:
+            self.schedule(url)
+
+    def holdFor(self, url, block):
+        """
+        Readings held by block are stored, by calling its release method, just before
+        the values for url are sent, so that they wait no longer than other values.
+        """
+        if not url in self.held:
+            self.held[url] = []
+        self.held[url].append(block)
+        if self.controller:
+            self.controller.arrived(url, 0)
+        self.schedule(url)
+
+    def schedule(self, url):
+        """ Starts the timer to send the values for url, if it isn't running """
+        if config["batch_upload"] == "True":
+            if not self.flushTimer:
+                self.flushTimer = timers.callLater(self.controller.delay() if self.controller else SEND_DELAY, self.flush)
+        elif not url in self.waiting:
+            timers.callLater(self.controller.delay(url) if self.controller else SEND_DELAY, self.sendValues, url)
+            self.waiting.append(url)
+
+    def queueDepths(self):
+        """ Returns the number of values waiting to be posted for each device """
+        depths = {}
+        for url in self.s:
+            for name in self.s[url]:
+                if config["batch_upload"] == "True":
+                    device = name.split("/")[0]
+                else:
+                    device = url.rsplit("/", 1)[1]
+                depths[device] = depths.get(device, 0) + len(self.s[url][name][0])
+        for url in self.events:
+            for v in self.events[url]:
+                if config["batch_upload"] == "True":
+                    device = v["n"].split("/")[0]
+                else:
+                    device = url.rsplit("/", 1)[1]
+                depths[device] = depths.get(device, 0) + 1
+        return depths
+
+    def storeValue(self, deviceID, name, timeStamp, value, da=False, event=False):
+        """ Values with event True, such as door openings, are posted at once rather than batched """
+        if self.history:
+            self.history.add(deviceID, name, timeStamp, value)
         if da:
-            url = self.daurl + deviceID
+            url = self.daurl
         else:
-            url = self.baseurl + deviceID
-        status = 0
-        headers = {'Content-Type': 'application/json'}
-        try:
-            r = requests.post(url, auth=(config["geras_key"], ''), data=json.dumps({"e": values}), headers=headers)
-            status = r.status_code
-            success = True
-        except Exception as inst:
-            self.cbLog("warning", "sendValues failed: " + str(type(inst)) + " " + str(inst.args))
-            success = False
-        if status !=200 or not success:
-            self.cbLog("debug", "sendValues failed, status: " + str(status))
-            # On error, store the values that weren't sent ready to be sent again
-            reactor.callFromThread(self.storeValues, values, deviceID)
-
-    def sendValues(self, deviceID, da):
-        values = self.s[deviceID]
-        # Call in thread as it may take a second or two
-        self.waiting.remove(deviceID)
-        del self.s[deviceID]
-        reactor.callInThread(self.sendValuesThread, values, deviceID, da)
-
-    def storeValues(self, values, deviceID, da=False):
-        if not deviceID in self.s:
-            self.s[deviceID] = values
+            url = self.baseurl
+        if event:
+            queue = self.queueEvent
         else:
-            self.s[deviceID].append(values)
-        if not deviceID in self.waiting:
-            reactor.callLater(SEND_DELAY, self.sendValues, deviceID, da)
-            self.waiting.append(deviceID)
-
-    def storeAccel(self, deviceID, timeStamp, a):
-        values = [
-                  {"n":"accel_x", "v":a[0], "t":timeStamp},
-                  {"n":"accel_y", "v":a[1], "t":timeStamp},
-                  {"n":"accel_z", "v":a[2], "t":timeStamp}
-                 ]
-        self.storeValues(values, deviceID)
-
-    def storeTemp(self, deviceID, timeStamp, temp):
-        values = [
-                  {"n":"temperature", "v":temp, "t":timeStamp}
-                 ]
-        self.storeValues(values, deviceID)
-
-    def storeIrTemp(self, deviceID, timeStamp, temp):
-        values = [
-                  {"n":"ir_temperature", "v":temp, "t":timeStamp}
-                 ]
-        self.storeValues(values, deviceID)
-
-    def storeHumidity(self, deviceID, timeStamp, h):
-        values = [
-                  {"n":"humidity", "v":h, "t":timeStamp}
-                 ]
-        self.storeValues(values, deviceID)
-
-    def storeButtons(self, deviceID, timeStamp, buttons):
-        values = [
-                  {"n":"left_button", "v":buttons["leftButton"], "t":timeStamp},
-                  {"n":"right_button", "v":buttons["rightButton"], "t":timeStamp}
-                 ]
-        self.storeValues(values, deviceID)
-
-    def storeGyro(self, deviceID, timeStamp, gyro):
-        values = [
-                  {"n":"gyro_x", "v":gyro[0], "t":timeStamp},
-                  {"n":"gyro_y", "v":gyro[1], "t":timeStamp},
-                  {"n":"gyro_z", "v":gyro[2], "t":timeStamp}
-                 ]
-        self.storeValues(values, deviceID)
-
-    def storeMagnet(self, deviceID, timeStamp, magnet):
-        values = [
-                  {"n":"magnet_x", "v":magnet[0], "t":timeStamp},
-                  {"n":"magnet_y", "v":magnet[1], "t":timeStamp},
-                  {"n":"magnet_z", "v":magnet[2], "t":timeStamp}
-                 ]
-        self.storeValues(values, deviceID)
-
-    def storeBinary(self, deviceID, timeStamp, b):
-        values = [
-                  {"n":"binary", "v":b, "t":timeStamp}
-                 ]
-        self.storeValues(values, deviceID)
-
-    def storeLuminance(self, deviceID, timeStamp, v):
-        values = [
-                  {"n":"luminance", "v":v, "t":timeStamp}
-                 ]
-        self.storeValues(values, deviceID)
-
-    def storePower(self, deviceID, timeStamp, v):
-        values = [
-                  {"n":"power", "v":v, "t":timeStamp}
-                 ]
-        self.storeValues(values, deviceID)
-
-    def storeBattery(self, deviceID, timeStamp, v):
-        values = [
-                  {"n":"battery", "v":v, "t":timeStamp}
-                 ]
-        self.storeValues(values, deviceID)
-
-    def storeConnected(self, deviceID, timeStamp, v):
-        values = [
-                  {"n":"connected", "v":v, "t":timeStamp}
-                 ]
-        self.storeValues(values, deviceID)
+            queue = self.queueValue
+        if config["batch_upload"] == "True":
+            # All devices are posted to the bridge series in one payload
+            queue(url, deviceID + "/" + name, timeStamp, value)
+        else:
+            queue(url + deviceID, name, timeStamp, value)
 
-    def storeEntryExit(self, location, timeStamp, action, v):
-        values = [
-                  {"n":action, "v":v, "t":timeStamp}
-                 ]
-        self.storeValues(values, location, True)
-
-class Accelerometer:
-    def __init__(self, id):
-        self.previous = [0.0, 0.0, 0.0]
-        self.id = id
+    def hold(self, deviceID, block):
+        if config["batch_upload"] == "True":
+            self.holdFor(self.baseurl, block)
+        else:
+            self.holdFor(self.baseurl + deviceID, block)
 
-    def processAccel(self, resp):
-        accel = [resp["data"]["x"], resp["data"]["y"], resp["data"]["z"]]
-        timeStamp = resp["timeStamp"]
-        event = False
-        for a in range(3):
-            if abs(accel[a] - self.previous[a]) > config["accel_min_change"]:
-                event = True
-                break
+    def storeEntryExit(self, location, timeStamp, action, v):
+        self.storeValue(location, action, timeStamp, v, True, True)
+
+class BridgeData():
+    """
+    Stores the values of one bridge through a DataManager shared by all the bridges
+    in a gateway shard, so that their values are batched into the same posts. Each
+    series is named in full, eg. BID12/Kitchen/temperature, and posted to series_url.
+    """
+    def __init__(self, dm, bridge_id):
+        self.dm = dm
+        self.prefix = bridge_id + "/"
+        self.daPrefix = "DA" + bridge_id[3:] + "/"
+        self.history = None
+
+    def storeValue(self, deviceID, name, timeStamp, value, da=False, event=False):
+        if self.history:
+            self.history.add(deviceID, name, timeStamp, value)
         if event:
-            self.dm.storeAccel(self.id, timeStamp, accel)
-            self.previous = accel
-
-class TemperatureMeasure():
-    """ Either send temp every minute or when it changes. """
-    def __init__(self, id):
-        # self.mode is either regular or on_change
-        self.mode = "on_change"
-        self.minChange = 0.2
-        self.id = id
-        epochTime = time.time()
-        self.prevEpochMin = int(epochTime - epochTime%60)
-        self.powerTemp = 0.0
-
-    def processTemp (self, resp):
-        timeStamp = resp["timeStamp"] 
-        temp = resp["data"]
-        if self.mode == "regular":
-            epochMin = int(timeStamp - timeStamp%60)
-            if epochMin != self.prevEpochMin:
-                temp = resp["data"]
-                self.dm.storeTemp(self.id, self.prevEpochMin, temp) 
-                self.prevEpochMin = epochMin
+            queue = self.dm.queueEvent
         else:
-            if abs(temp-self.powerTemp) >= config["temp_min_change"]:
-                self.dm.storeTemp(self.id, timeStamp, temp) 
-                self.powerTemp = temp
-
-class IrTemperatureMeasure():
-    """ Either send temp every minute or when it changes. """
-    def __init__(self, id):
-        # self.mode is either regular or on_change
-        self.mode = "on_change"
-        self.minChange = 0.2
-        self.id = id
-        epochTime = time.time()
-        self.prevEpochMin = int(epochTime - epochTime%60)
-        self.powerTemp = 0.0
-
-    def processIrTemp (self, resp):
-        timeStamp = resp["timeStamp"] 
-        temp = resp["data"]
-        if self.mode == "regular":
-            epochMin = int(timeStamp - timeStamp%60)
-            if epochMin != self.prevEpochMin:
-                temp = resp["data"]
-                self.dm.storeIrTemp(self.id, self.prevEpochMin, temp) 
-                self.prevEpochMin = epochMin
+            queue = self.dm.queueValue
+        if da:
+            queue(self.dm.baseurl, self.daPrefix + deviceID + "/" + name, timeStamp, value)
         else:
-            if abs(temp-self.powerTemp) >= config["irtemp_min_change"]:
-                self.dm.storeIrTemp(self.id, timeStamp, temp) 
-                self.powerTemp = temp
+            queue(self.dm.baseurl, self.prefix + deviceID + "/" + name, timeStamp, value)
 
-class Buttons():
-    def __init__(self, id):
-        self.id = id
+    def hold(self, deviceID, block):
+        self.dm.holdFor(self.dm.baseurl, block)
 
-    def processButtons(self, resp):
-        timeStamp = resp["timeStamp"] 
-        buttons = resp["data"]
-        self.dm.storeButtons(self.id, timeStamp, buttons)
+    def storeEntryExit(self, location, timeStamp, action, v):
+        self.storeValue(location, action, timeStamp, v, True, True)
 
-class Gyro():
-    def __init__(self, id):
-        self.id = id
-        self.previous = [0.0, 0.0, 0.0]
-
-    def processGyro(self, resp):
-        gyro = [resp["data"]["x"], resp["data"]["y"], resp["data"]["z"]]
-        timeStamp = resp["timeStamp"] 
-        event = False
-        for a in range(3):
-            if abs(gyro[a] - self.previous[a]) > config["gyro_min_change"]:
-                event = True
-                break
-        if event:
-            self.dm.storeGyro(self.id, timeStamp, gyro)
-            self.previous = gyro
+class HistorySeries(object):
+    """
+    The most recent values of one series in time order, in a ring buffer that grows
+    up to maxValues. Values are nearly always added in order; one that is not is
+    moved back to its place.
+    """
+    __slots__ = ("times", "values", "start", "count")
 
-class Magnet():
-    def __init__(self, id):
-        self.id = id
-        self.previous = [0.0, 0.0, 0.0]
-
-    def processMagnet(self, resp):
-        mag = [resp["data"]["x"], resp["data"]["y"], resp["data"]["z"]]
-        timeStamp = resp["timeStamp"] 
-        event = False
-        for a in range(3):
-            if abs(mag[a] - self.previous[a]) > config["magnet_min_change"]:
-                event = True
-                break
-        if event:
-            self.dm.storeMagnet(self.id, timeStamp, mag)
-            self.previous = mag
-
-class Humid():
-    """ Either send temp every minute or when it changes. """
-    def __init__(self, id):
-        self.id = id
-        self.previous = 0.0
+    def __init__(self):
+        self.times = array("d")
+        self.values = array("d")
+        self.start = 0
+        self.count = 0
 
-    def processHumidity (self, resp):
-        h = resp["data"]
-        timeStamp = resp["timeStamp"] 
-        if abs(self.previous) >= config["humidity_min_change"]:
-            self.dm.storeHumidity(self.id, timeStamp, h) 
-            self.previous = h
+    def time(self, i):
+        return self.times[(self.start + i) % len(self.times)]
+
+    def value(self, i):
+        return self.values[(self.start + i) % len(self.times)]
+
+    def index(self, t, right=False):
+        """ Like bisect, the position of t among the times held """
+        lo = 0
+        hi = self.count
+        while lo < hi:
+            mid = (lo + hi)//2
+            tm = self.time(mid)
+            if tm < t or (right and tm == t):
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def add(self, t, v, maxValues, maxAge):
+        size = len(self.times)
+        if self.count == size:
+            if size < maxValues:
+                if self.start:
+                    self.times = self.times[self.start:] + self.times[:self.start]
+                    self.values = self.values[self.start:] + self.values[:self.start]
+                    self.start = 0
+                self.times.append(0.0)
+                self.values.append(0.0)
+                size += 1
+            elif t < self.time(0):
+                # Older than every value held, so it would be the one evicted
+                return
+            else:
+                # Overwrite the oldest value, which is no newer than t
+                self.start = (self.start + 1) % size
+                self.count -= 1
+        i = self.count
+        self.count += 1
+        while i > 0 and self.time(i - 1) > t:
+            j = (self.start + i) % size
+            k = (self.start + i - 1) % size
+            self.times[j] = self.times[k]
+            self.values[j] = self.values[k]
+            i -= 1
+        j = (self.start + i) % size
+        self.times[j] = t
+        self.values[j] = v
+        oldest = self.time(self.count - 1) - maxAge
+        while self.time(0) < oldest:
+            self.start = (self.start + 1) % size
+            self.count -= 1
+
+class History():
+    """
+    Keeps the last history_hours of every series stored, up to history_max_values
+    values each, so that recent values can be read without asking the database.
+    Series are named as they are stored, by device and characteristic. Values that
+    are not numbers are not kept.
+    """
+    def __init__(self):
+        self.series = {}    # (device, name) -> HistorySeries
 
-class Binary():
-    def __init__(self, id):
+    def add(self, deviceID, name, timeStamp, value):
+        try:
+            value = float(value)
+        except (TypeError, ValueError):
+            return
+        key = (deviceID, name)
+        if not key in self.series:
+            self.series[key] = HistorySeries()
+        self.series[key].add(timeStamp, value, config["history_max_values"], config["history_hours"]*3600)
+
+    def names(self):
+        return sorted(d + "/" + n for d, n in self.series)
+
+    def latest(self, deviceID, name):
+        """ Returns (timeStamp, value) of the newest value of a series, or None """
+        s = self.series.get((deviceID, name))
+        if not s or not s.count:
+            return None
+        return (s.time(s.count - 1), s.value(s.count - 1))
+
+    def range(self, deviceID, name, start, end):
+        """ Returns a list of (timeStamp, value) from start to end inclusive """
+        s = self.series.get((deviceID, name))
+        if not s:
+            return []
+        return [(s.time(i), s.value(i)) for i in range(s.index(start), s.index(end, True))]
+
+    def downsample(self, deviceID, name, start, end, interval):
+        """
+        Returns a list of (bucket start, mean, min, max, count) for each interval from
+        start that has values in it
+        """
+        buckets = []
+        for t, v in self.range(deviceID, name, start, end):
+            b = start + ((t - start)//interval)*interval
+            if buckets and buckets[-1][0] == b:
+                bucket = buckets[-1]
+                bucket[1] += v
+                bucket[2] = min(bucket[2], v)
+                bucket[3] = max(bucket[3], v)
+                bucket[4] += 1
+            else:
+                buckets.append([b, v, v, v, 1])
+        return [(b[0], b[1]/b[4], b[2], b[3], b[4]) for b in buckets]
+
+    def getStats(self):
+        return {"series": len(self.series),
+                "values": sum(s.count for s in self.series.values())}
+
+histories = {}  # bridge id -> History, for HistoryResource
+
+class HistoryResource(resource.Resource):
+    """
+    Serves recent history as JSON. GET /history lists the series held, and
+    /history?series=Kitchen/temperature gives its newest value. start and end (epoch
+    seconds) give the values between them, and interval downsamples them. In gateway
+    mode the bridge must also be given, eg. bridge=BID12.
+    """
+    isLeaf = True
+
+    def render_GET(self, request):
+        request.setHeader("Content-Type", "application/json")
+        args = dict((k.decode("utf-8"), v[0].decode("utf-8")) for k, v in request.args.items())
+        if "bridge" in args:
+            history = histories.get(args["bridge"])
+        elif len(histories) == 1:
+            history = list(histories.values())[0]
+        else:
+            history = None
+        if not history:
+            request.setResponseCode(404)
+            return json.dumps({"error": "no history for this bridge"}).encode("utf-8")
+        if not "series" in args:
+            return json.dumps({"series": history.names()}).encode("utf-8")
+        try:
+            device, name = args["series"].rsplit("/", 1)
+            if "start" in args:
+                start = float(args["start"])
+                end = float(args.get("end", clock.time()))
+                if "interval" in args:
+                    result = {"values": history.downsample(device, name, start, end, float(args["interval"]))}
+                else:
+                    result = {"values": history.range(device, name, start, end)}
+            else:
+                result = {"latest": history.latest(device, name)}
+        except ValueError:
+            request.setResponseCode(400)
+            return json.dumps({"error": "series must be device/name, and start, end and interval numbers"}).encode("utf-8")
+        return json.dumps(result).encode("utf-8")
+
+class SwingingDoor(object):
+    """
+    Swinging-door compression for a scalar series. Readings are only sent when a
+    straight line from the last point sent can no longer pass within tolerance of
+    every reading since, so that joining the points sent never gives an error of
+    more than tolerance.
+    """
+    __slots__ = ("tolerance", "start", "last", "low", "high")
+
+    def __init__(self, tolerance):
+        self.tolerance = tolerance
+        self.start = None
+        self.last = None
+
+    def add(self, t, v):
+        """ Returns a list of (timeStamp, value) points to send """
+        if self.start is None:
+            self.restart((t, v))
+            return [(t, v)]
+        t0, v0 = self.start
+        if t <= self.last[0]:
+            return []
+        dt = t - t0
+        low = max(self.low, (v - self.tolerance - v0)/dt)
+        high = min(self.high, (v + self.tolerance - v0)/dt)
+        if low <= high and dt <= COMPRESSION_MAX_INTERVAL:
+            self.low = low
+            self.high = high
+            self.last = (t, v)
+            return []
+        # The doors have closed. End the segment at the previous reading, on a line
+        # that is within tolerance of all the readings in the segment.
+        tl, vl = self.last
+        if tl == t0:
+            # Nothing since the last point sent
+            self.restart((t, v))
+            return [(t, v)]
+        slope = min(max((vl - v0)/(tl - t0), self.low), self.high)
+        point = (tl, v0 + slope*(tl - t0))
+        self.restart(point)
+        dt = t - tl
+        self.low = (v - self.tolerance - point[1])/dt
+        self.high = (v + self.tolerance - point[1])/dt
+        self.last = (t, v)
+        return [point]
+
+    def restart(self, point):
+        self.start = point
+        self.last = point
+        self.low = float("-inf")
+        self.high = float("inf")
+
+class Rollup():
+    """
+    Mean, min, max, count and last value of one series over consecutive windows of
+    a fixed number of seconds, aligned to the epoch. Each window is sent when the
+    first value of the next one arrives, or ROLLUP_GRACE seconds after it ends.
+    """
+    def __init__(self, stage, name, window):
+        self.stage = stage
+        self.name = name + "_" + str(window) + "s_"
+        self.window = window
+        self.start = None
+        self.timer = None
+
+    def add(self, t, v):
+        start = t - t % self.window
+        if start != self.start:
+            if self.start is not None:
+                self.send()
+            self.start = start
+            self.count = 0
+            self.total = 0.0
+            self.min = v
+            self.max = v
+            self.timer = timers.callLater(max(0, start + self.window - clock.time()) + ROLLUP_GRACE, self.send)
+        self.count += 1
+        self.total += v
+        self.last = v
+        if v < self.min:
+            self.min = v
+        elif v > self.max:
+            self.max = v
+
+    def send(self):
+        if self.timer and self.timer.active():
+            self.timer.cancel()
+        self.timer = None
+        if self.start is None:
+            return
+        dm = self.stage.dm
+        id = self.stage.id
+        dm.storeValue(id, self.name + "mean", self.start, self.total/self.count)
+        dm.storeValue(id, self.name + "min", self.start, self.min)
+        dm.storeValue(id, self.name + "max", self.start, self.max)
+        dm.storeValue(id, self.name + "count", self.start, self.count)
+        dm.storeValue(id, self.name + "last", self.start, self.last)
+        self.start = None
+
+class RollupStage():
+    """
+    Rolls up one characteristic of one device over each of the windows configured
+    for it in rollups. Characteristics with x, y and z values are rolled up per axis.
+    """
+    def __init__(self, dm, id, characteristic, windows):
+        self.dm = dm
         self.id = id
-        self.previous = 0
+        self.characteristic = characteristic
+        self.windows = windows
+        self.rollups = {}
 
-    def processBinary(self, resp):
-        timeStamp = resp["timeStamp"] 
-        b = resp["data"]
-        if b == "on":
-            bi = 1
+    def process(self, resp):
+        timeStamp = resp["timeStamp"]
+        data = resp["data"]
+        if isinstance(data, dict):
+            items = [(self.characteristic + "_" + k, data[k]) for k in data]
         else:
-            bi = 0
-        if bi != self.previous:
-            self.dm.storeBinary(self.id, timeStamp-1.0, self.previous)
-            self.dm.storeBinary(self.id, timeStamp, bi)
-            self.previous = bi
-
-class Luminance():
-    def __init__(self, id):
+            items = [(self.characteristic, data)]
+        for name, v in items:
+            if v in ("on", "off"):
+                v = int(v == "on")
+            elif isinstance(v, bool):
+                v = int(v)
+            elif not isinstance(v, (int, float)):
+                continue
+            if not name in self.rollups:
+                self.rollups[name] = [Rollup(self, name, w) for w in self.windows]
+            for r in self.rollups[name]:
+                r.add(timeStamp, v)
+
+class Processor(object):
+    """
+    Processes one characteristic of one device, as described by its entry in SENSORS.
+    State is kept in slots and thresholds are read from config when the processor is
+    created, so nothing is looked up in config for each message.
+    """
+    __slots__ = ("dm", "id", "characteristic", "series")
+
+    def __init__(self, dm, id, characteristic, spec):
+        self.dm = dm
         self.id = id
-        self.previous = 0
+        self.characteristic = characteristic
+        self.series = spec["series"]
 
-    def processLuminance(self, resp):
-        v = resp["data"]
-        timeStamp = resp["timeStamp"] 
-        if abs(v-self.previous) >= config["luminance_min_change"]:
-            self.dm.storeLuminance(self.id, timeStamp, v) 
-            self.previous = v
+class Deadband(Processor):
+    """ Sends a value when it has changed by at least <config>_min_change since the last value sent """
+    __slots__ = ("threshold", "previous")
 
-class Power():
-    def __init__(self, id):
-        self.id = id
-        self.previous = 0
-        self.previousTime = time.time()
+    def __init__(self, dm, id, characteristic, spec):
+        Processor.__init__(self, dm, id, characteristic, spec)
+        self.threshold = config[spec["config"] + "_min_change"]
+        self.previous = 0.0
 
-    def processPower(self, resp):
+    def process(self, resp):
         v = resp["data"]
-        timeStamp = resp["timeStamp"] 
-        if abs(v-self.previous) >= config["power_min_change"]:
-            if timeStamp - self.previousTime > 2:
-                self.dm.storePower(self.id, timeStamp-1.0, self.previous)
-            self.dm.storePower(self.id, timeStamp, v) 
+        if abs(v - self.previous) >= self.threshold:
+            self.dm.storeValue(self.id, self.series, resp["timeStamp"], v)
             self.previous = v
-            self.previousTime = timeStamp
+        else:
+            metrics.count("dropped", self.characteristic)
 
-class Battery():
-    def __init__(self, id):
-        self.id = id
-        self.previous = 0
+class StepDeadband(Deadband):
+    """
+    As Deadband, but if the value has not changed for more than 2 seconds the
+    previous value is also sent just before the new one, so that steps are kept.
+    """
+    __slots__ = ("previousTime",)
 
-    def processBattery(self, resp):
+    def __init__(self, dm, id, characteristic, spec):
+        Deadband.__init__(self, dm, id, characteristic, spec)
+        self.previousTime = clock.time()
+
+    def process(self, resp):
         v = resp["data"]
-        timeStamp = resp["timeStamp"] 
-        if abs(v-self.previous) >= config["battery_min_change"]:
-            self.dm.storeBattery(self.id, timeStamp, v) 
+        timeStamp = resp["timeStamp"]
+        if abs(v - self.previous) >= self.threshold:
+            if timeStamp - self.previousTime > 2:
+                self.dm.storeValue(self.id, self.series, timeStamp-1.0, self.previous)
+            self.dm.storeValue(self.id, self.series, timeStamp, v)
             self.previous = v
-
-class Connected():
-    def __init__(self, id):
-        self.id = id
+            self.previousTime = timeStamp
+        else:
+            metrics.count("dropped", self.characteristic)
+
+class Compressed(Processor):
+    """ Used in place of Deadband or StepDeadband when <config>_compression is swinging_door """
+    __slots__ = ("door",)
+
+    def __init__(self, dm, id, characteristic, spec):
+        Processor.__init__(self, dm, id, characteristic, spec)
+        self.door = SwingingDoor(config[spec["config"] + "_min_change"])
+
+    def process(self, resp):
+        points = self.door.add(resp["timeStamp"], resp["data"])
+        if not points:
+            metrics.count("dropped", self.characteristic)
+        for t, v in points:
+            self.dm.storeValue(self.id, self.series, t, v)
+
+class Change(Processor):
+    """
+    Two-state values, sent as 0 or 1. On a change, the previous state is sent one
+    second before the new one, so that changes are drawn as steps. Values equal to
+    spec["on"] are 1, or any true value if it is None.
+    """
+    __slots__ = ("on", "previous")
+
+    def __init__(self, dm, id, characteristic, spec):
+        Processor.__init__(self, dm, id, characteristic, spec)
+        self.on = spec["on"]
         self.previous = 0
 
-    def processConnected(self, resp):
+    def process(self, resp):
         v = resp["data"]
-        timeStamp = resp["timeStamp"] 
-        if v:
-            b = 1
+        timeStamp = resp["timeStamp"]
+        if self.on is None:
+            b = 1 if v else 0
         else:
-            b = 0
+            b = 1 if v == self.on else 0
         if b != self.previous:
-            self.dm.storeConnected(self.id, timeStamp-1.0, self.previous)
-            self.dm.storeConnected(self.id, timeStamp, b) 
+            self.dm.storeValue(self.id, self.series, timeStamp-1.0, self.previous, event=True)
+            self.dm.storeValue(self.id, self.series, timeStamp, b, event=True)
             self.previous = b
 
+class Fields(Processor):
+    """ Sends every field of every message, on the event lane. spec["series"] maps field names to series names. """
+    __slots__ = ()
+
+    def process(self, resp):
+        timeStamp = resp["timeStamp"]
+        data = resp["data"]
+        for field, name in self.series:
+            self.dm.storeValue(self.id, name, timeStamp, data[field], event=True)
+
+class MotionBlock(Processor):
+    """
+    Gathers readings from a 3-axis sensor and processes them a block at a time.
+    A reading is sent if any axis has changed by more than <config>_min_change since
+    the last reading sent. If motion_stats is True, the mean, min, max and standard
+    deviation of the vector magnitude over each block are also sent. A block that
+    hasn't filled is processed when the DataManager next sends the device's values.
+    """
+    __slots__ = ("threshold", "blockSize", "stats", "names", "previous", "times", "readings", "held")
+
+    def __init__(self, dm, id, characteristic, spec):
+        Processor.__init__(self, dm, id, characteristic, spec)
+        self.threshold = config[spec["config"] + "_min_change"]
+        self.blockSize = config["motion_block_size"]
+        self.stats = config["motion_stats"] == "True"
+        self.names = [self.series + "_" + n for n in ("x", "y", "z")]
+        self.previous = (0.0, 0.0, 0.0)
+        self.times = []
+        self.readings = []
+        self.held = False   # True while the DataManager will release this block
+
+    def process(self, resp):
+        data = resp["data"]
+        self.times.append(resp["timeStamp"])
+        self.readings.append((data["x"], data["y"], data["z"]))
+        if len(self.times) >= self.blockSize:
+            self.flush()
+        elif not self.held:
+            self.held = True
+            self.dm.hold(self.id, self)
+
+    def release(self):
+        self.held = False
+        self.flush()
+
+    def flush(self):
+        times = self.times
+        readings = self.readings
+        self.times = []
+        self.readings = []
+        if not times:
+            return
+        dm = self.dm
+        id = self.id
+        nx, ny, nz = self.names
+        px, py, pz = self.previous
+        threshold = self.threshold
+        sent = 0
+        for i in range(len(readings)):
+            x, y, z = readings[i]
+            if abs(x - px) > threshold or abs(y - py) > threshold or abs(z - pz) > threshold:
+                dm.storeValue(id, nx, times[i], x)
+                dm.storeValue(id, ny, times[i], y)
+                dm.storeValue(id, nz, times[i], z)
+                px, py, pz = x, y, z
+                sent += 1
+        self.previous = (px, py, pz)
+        metrics.count("dropped", self.characteristic, len(readings) - sent)
+        if self.stats:
+            for name, v in zip(("mean", "min", "max", "std"), self.magnitudeStats(readings)):
+                dm.storeValue(id, self.series + "_magnitude_" + name, times[-1], v)
+
+    def magnitudeStats(self, readings):
+        magnitude = [math.sqrt(x*x + y*y + z*z) for x, y, z in readings]
+        mean = sum(magnitude)/len(magnitude)
+        std = math.sqrt(sum((m - mean)**2 for m in magnitude)/len(magnitude))
+        return mean, min(magnitude), max(magnitude), std
+
+# How each characteristic is processed:
+#   enable:    config value that turns it on
+#   interval:  config value for the polling interval requested from the adaptor, or None for events
+#   processor: Processor class
+#   series:    name of the series sent (series prefix for MotionBlock, field to series pairs for Fields)
+#   config:    prefix of the _min_change and _compression config values
+SENSORS = {
+    "temperature":    {"enable": "temperature", "interval": "slow_polling_interval", "processor": Deadband,
+                       "series": "temperature", "config": "temp"},
+    "ir_temperature": {"enable": "irtemperature", "interval": "slow_polling_interval", "processor": Deadband,
+                       "series": "ir_temperature", "config": "irtemp"},
+    "humidity":       {"enable": "humidity", "interval": "slow_polling_interval", "processor": Deadband,
+                       "series": "humidity", "config": "humidity"},
+    "luminance":      {"enable": "luminance", "interval": None, "processor": Deadband,
+                       "series": "luminance", "config": "luminance"},
+    "power":          {"enable": "power", "interval": None, "processor": StepDeadband,
+                       "series": "power", "config": "power"},
+    "battery":        {"enable": "battery", "interval": None, "processor": Deadband,
+                       "series": "battery", "config": "battery"},
+    "binary_sensor":  {"enable": "binary", "interval": None, "processor": Change,
+                       "series": "binary", "on": "on"},
+    "connected":      {"enable": "connected", "interval": None, "processor": Change,
+                       "series": "connected", "on": None},
+    "buttons":        {"enable": "buttons", "interval": None, "processor": Fields,
+                       "series": (("leftButton", "left_button"), ("rightButton", "right_button"))},
+    "acceleration":   {"enable": "accel", "interval": "accel_polling_interval", "processor": MotionBlock,
+                       "series": "accel", "config": "accel"},
+    "gyro":           {"enable": "gyro", "interval": "gyro_polling_interval", "processor": MotionBlock,
+                       "series": "gyro", "config": "gyro"},
+    "magnetometer":   {"enable": "magnet", "interval": "magnet_polling_interval", "processor": MotionBlock,
+                       "series": "magnet", "config": "magnet"}
+}
+
+def makeProcessor(dm, id, characteristic):
+    spec = SENSORS[characteristic]
+    processor = spec["processor"]
+    if processor in (Deadband, StepDeadband) and config.get(spec["config"] + "_compression") == "swinging_door":
+        processor = Compressed
+    return processor(dm, id, characteristic, spec)
+
 class Client():
+    """
+    Reliable delivery of messages to the concentrator client. Each message is given
+    a sequence number, n, which the client acks. Up to client_window messages may be
+    awaiting an ack at once, and later ones wait in order. A message that is not
+    acked is resent with an exponentially increasing delay, and an ack brings forward
+    the resends of the others, as the client is evidently reachable again. A message
+    that has to wait for the window is a reason to resend the oldest one at once, to
+    find out whether it is. A message sent client_max_attempts times without an ack
+    is dropped, as are the oldest if more than client_max_messages are waiting.
+    """
     def __init__(self, aid):
         self.aid = aid
         self.count = 0
-        self.messages = []
+        self.outstanding = collections.OrderedDict()  # n -> [message, timer, attempts, first sent, last sent]
+        self.backlog = collections.deque()
+        self.backedOff = set()  # outstanding messages that have been resent
 
     def send(self, message):
         message["body"]["n"] = self.count
         self.count += 1
-        self.messages.append(message)
-        self.sendMessage(message, "conc")
+        self.backlog.append(message)
+        if len(self.outstanding) + len(self.backlog) > config["client_max_messages"]:
+            # The oldest message that has not been sent yet. Outstanding ones are kept, as the client may have them.
+            dropped = self.backlog.popleft()
+            self.cbLog("warning", "Client queue full, dropped message: " + str(dropped))
+            metrics.count("client", "dropped")
+        self.fill()
+        if self.backlog:
+            # The window is full, so probe the client rather than wait for a backed off resend
+            oldest = self.outstanding[next(iter(self.outstanding))]
+            if clock.time() - oldest[4] >= config["client_retry_interval"]:
+                oldest[1].reset(0)
+
+    def fill(self):
+        while self.backlog and len(self.outstanding) < config["client_window"]:
+            message = self.backlog.popleft()
+            self.outstanding[message["body"]["n"]] = [message, None, 0, clock.time(), 0]
+            self.transmit(message["body"]["n"])
+
+    def transmit(self, n):
+        entry = self.outstanding[n]
+        delay = min(config["client_retry_max_delay"], config["client_retry_interval"] * 2**min(entry[2], 16))
+        entry[1] = timers.callLater(delay, self.retransmit, n)
+        entry[4] = clock.time()
+        self.sendMessage(entry[0], "conc")
+        metrics.count("client", "sent")
+
+    def retransmit(self, n):
+        if n in self.outstanding:
+            if self.outstanding[n][2] + 1 >= config["client_max_attempts"]:
+                message = self.outstanding.pop(n)[0]
+                self.backedOff.discard(n)
+                self.cbLog("warning", "Client did not ack, dropped message: " + str(message))
+                metrics.count("client", "dropped")
+                self.fill()
+                return
+            self.outstanding[n][2] += 1
+            self.backedOff.add(n)
+            self.cbLog("debug", "Resending message " + str(n) + " to client")
+            metrics.count("client", "resent")
+            self.transmit(n)
+
+    def getStats(self):
+        return {"outstanding": len(self.outstanding), "backlog": len(self.backlog), "next": self.count}
 
     def receive(self, message):
         self.cbLog("debug", "Message from client: " + str(message))
         if "body" in message:
             if "n" in message["body"]:
-                self.cbLog("debug", "Received ack from client: " + str(message["body"]["n"]))
-                for m in self.messages:
-                    if m["body"]["n"] == m:
-                        self.messages.remove(m)
-                        self.cbLog("debug", "Removed message " + str(m) + " from queue")
+                n = message["body"]["n"]
+                self.cbLog("debug", "Received ack from client: " + str(n))
+                entry = self.outstanding.pop(n, None)
+                if entry:
+                    entry[1].cancel()
+                    self.backedOff.discard(n)
+                    metrics.observe("client_ack_latency", clock.time() - entry[3])
+                    for n in self.backedOff:
+                        # Backed off while the client was unreachable, so resend now
+                        self.outstanding[n][2] = 0
+                        self.outstanding[n][1].reset(0)
+                    self.backedOff.clear()
+                    self.fill()
         else:
             self.cbLog("warning", "Received message from client with no body")
 
-class pillbox():
-    def __init__(self):
-        self.magnet_av = [0.0, 0.0, 0.0]
-
-    def updateMagnet(self, mag):
-        self.current = mag
-
-    def calcAverage(self):
-        points_to_average = 16
+class RollingStats(object):
+    """
+    Mean and variance of the last size values, kept in a ring buffer. Each value is
+    added in constant time by updating the mean and sum of squared differences for
+    the value that is replaced, rather than summing the buffer again.
+    """
+    __slots__ = ("size", "buffer", "index", "count", "mean", "m2")
+
+    def __init__(self, size):
+        self.size = size
+        self.buffer = array("d", [0.0]*size)
+        self.index = 0
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+
+    def add(self, x):
+        if self.count < self.size:
+            # Filling the buffer, so Welford's update
+            self.count += 1
+            delta = x - self.mean
+            self.mean += delta/self.count
+            self.m2 += delta*(x - self.mean)
+        else:
+            old = self.buffer[self.index]
+            mean = self.mean + (x - old)/self.size
+            self.m2 = max(0.0, self.m2 + (x - old)*(x - mean + old - self.mean))
+            self.mean = mean
+        self.buffer[self.index] = x
+        self.index += 1
+        if self.index == self.size:
+            self.index = 0
+
+    def variance(self):
+        if self.count == 0:
+            return 0.0
+        return self.m2/self.count
+
+class Pillbox(object):
+    """
+    Detects a pillbox being opened from the magnetometer on it. A reading is activity
+    if its magnitude differs from the mean of the last pillbox_window readings by more
+    than pillbox_threshold standard deviations plus pillbox_min_change. Activity
+    inside one of the pillbox_start/pillbox_end windows is sent as pillbox_activity.
+    If there has been none by the end of a window, pillbox_missed is sent and the
+    client is alerted.
+    """
+    __slots__ = ("dm", "id", "name", "aid", "client", "stats", "windows", "threshold", "minChange", "holdOff",
+                 "lastEvent", "activity", "lastEnd")
+
+    def __init__(self, dm, id, name, aid, client):
+        self.dm = dm
+        self.id = id
+        self.name = name
+        self.aid = aid
+        self.client = client
+        self.stats = RollingStats(config["pillbox_window"])
+        self.windows = [TimeWindow(start, end) for start, end in zip(config["pillbox_start"], config["pillbox_end"])]
+        self.threshold = config["pillbox_threshold"]
+        self.minChange = config["pillbox_min_change"]
+        self.holdOff = config["pillbox_hold_off"]
+        self.lastEvent = 0
+        now = clock.time()
+        # If started part way through a window, don't report it as missed
+        self.activity = [now if w.contains(now) else 0 for w in self.windows]
+        self.lastEnd = [now - 1]*len(self.windows)
+        for i in range(len(self.windows)):
+            self.scheduleEnd(i, now)
+
+    def process(self, resp):
+        data = resp["data"]
+        t = resp["timeStamp"]
+        m = math.sqrt(data["x"]**2 + data["y"]**2 + data["z"]**2)
+        stats = self.stats
+        if stats.count == stats.size and t - self.lastEvent > self.holdOff:
+            if abs(m - stats.mean) > self.threshold*math.sqrt(stats.variance()) + self.minChange:
+                self.lastEvent = t
+                inside = False
+                for i in range(len(self.windows)):
+                    if self.windows[i].contains(t):
+                        self.activity[i] = t
+                        inside = True
+                if inside:
+                    self.dm.storeValue(self.id, "pillbox_activity", t, 1, event=True)
+        stats.add(m)
+
+    def scheduleEnd(self, i, now):
+        end = self.windows[i].nextEnd(now)
+        timers.callLater(max(0, end - clock.time()), self.windowEnd, i, end)
+
+    def windowEnd(self, i, end):
+        if self.activity[i] <= self.lastEnd[i]:
+            self.dm.storeValue(self.id, "pillbox_missed", end, 1, event=True)
+            msg = {
+                   "source": self.aid,
+                   "destination": config["cid"],
+                   "body": {"m": "pillbox",
+                            "s": self.name,
+                            "t": end
+                           }
+                  }
+            self.client.send(msg)
+        self.lastEnd[i] = end
+        self.scheduleEnd(i, end + 1)
 
 class NightWander():
     def __init__(self, aid):
         global config
         self.aid = aid
         self.lastActive = 0
+        self.window = TimeWindow(config["night_start"], config["night_end"])
         if config["client_test"] == 'True':
-            reactor.callLater(30, self.clientTest)
+            timers.callLater(30, self.clientTest)
 
     def clientTest(self):
         self.cbLog("debug", "clientTest")
@@ -468,36 +1839,37 @@ class NightWander():
                "destination": config["cid"],
                "body": {"m": "alarm",
                         "s": "Test",
-                        "t": time.time()
+                        "t": clock.time()
                        }
               }
         self.client.send(msg)
-        reactor.callLater(20, self.clientTest)
+        timers.callLater(20, self.clientTest)
 
     def setNames(self, idToName):
+        """ Sets self.sensors to the ids of the night_sensors, which are given by name. All sensors if there are none. """
         self.idToName = idToName
+        self.sensors = set()
         if config["night_wandering"] == "True":
             if config["night_sensors"] == []:
                 for d in idToName:
-                    config["night_sensors"].append(d)
+                    self.sensors.add(d)
             else:
                 for n in config["night_sensors"]:
                     found = False
                     for d in idToName:
                         self.cbLog("debug", "NightWander. Matching n: " + n + " with d: " + d + " , idToName[d]: " + idToName[d])
-                        if n == idToName[d]:
-                            loc = config["night_sensors"].index(n) 
-                            config["night_sensors"][loc] = d
+                        if n == idToName[d] or n == d:
+                            self.sensors.add(d)
                             found = True
                             break
                     if not found:
                         self.cbLog("info", "NightWander. Sensor name does not exist: " + n)
-            self.cbLog("debug", "NightWander. night sensors: " + str(config["night_sensors"]))
+            self.cbLog("debug", "NightWander. night sensors: " + str(self.sensors))
 
     def onChange(self, devID, timeStamp, value):
         self.cbLog("debug", "Night Wander onChange, devID: " + devID + " value: " + value)
         if value == "on":
-            alarm = betweenTimes(timeStamp, config["night_start"], config["night_end"])
+            alarm = self.window.contains(timeStamp)
             if alarm:
                 if timeStamp - self.lastActive > config["night_ignore_time"]:
                     self.cbLog("debug", "Night Wander: " + str(alarm) + ": " + str(time.asctime(time.localtime(timeStamp))))
@@ -512,6 +1884,20 @@ class NightWander():
                     self.client.send(msg)
                 self.lastActive = timeStamp
 
+    def alarms(self, events):
+        """
+        For offline analysis. Returns the (devID, timeStamp) of each alarm that onChange
+        would send for a list of (timeStamp, devID, value) in time order.
+        """
+        ons = [(d, t) for t, d, v in events if v == "on" and d in self.sensors]
+        alarms = []
+        for (d, t), night in zip(ons, self.window.containsMany([t for d, t in ons])):
+            if night:
+                if t - self.lastActive > config["night_ignore_time"]:
+                    alarms.append((d, t))
+                self.lastActive = t
+        return alarms
+
 class EntryExit():
     def __init__(self):
         self.inside_triggered = False
@@ -579,6 +1965,10 @@ class EntryExit():
                 self.checkExit[l["location"]].onChange("ipir", timeStamp, value)
 
 class CheckExit():
+    """
+    Entry/exit state machine for one door. It runs when one of its sensors
+    changes and when a timed state reaches its deadline, not continuously.
+    """
     def __init__(self, location):
         self.location = location
         self.inside_pir_on_time = 0
@@ -588,10 +1978,14 @@ class CheckExit():
         self.door_open_time = 0
         self.door_close_time = 0
         self.state = "idle"
-        reactor.callLater(10, self.fsm)
+        self.deadline = None
 
     def onChange(self, sensor, timeStamp, value):
         self.cbLog("debug", "CheckExit, onChange. loc: " + self.location + " sensor: " + sensor)
+        self.update(sensor, timeStamp, value)
+        self.fsm()
+
+    def update(self, sensor, timeStamp, value):
         if sensor == "ipir":
             if value == "on":
                 self.inside_pir_on_time = timeStamp
@@ -606,9 +2000,33 @@ class CheckExit():
             else:
                 self.door_open = False
                 self.door_close_time = timeStamp
-              
+
     def fsm(self):
-        # This method is called every second
+        if self.deadline and self.deadline.active():
+            self.deadline.cancel()
+        self.deadline = None
+        deadline = self.run(clock.time())
+        if deadline is not None:
+            # The time checks in step are strict, so wake just after the deadline
+            self.deadline = timers.callLater(max(0, deadline - clock.time()) + DEADLINE_MARGIN, self.fsm)
+
+    def run(self, now):
+        """ Runs the machine at time now. Returns the time by which it must be run again, or None. """
+        # Keep stepping, as one change may move the machine on through several states
+        while True:
+            prev_state = self.state
+            self.step(now)
+            if self.state == prev_state:
+                break
+        if self.state == "check_went_out":
+            return self.door_close_time + DOOR_CLOSE_TO_IN_PIR_TIME
+        elif self.state == "check_coming_in":
+            return self.door_open_time + DOOR_OPEN_TO_IN_PIR_TIME
+        elif self.state == "wait_door_close":
+            return self.door_open_time + MAX_DOOR_OPEN_TIME
+        return None
+
+    def step(self, now):
         prev_state = self.state
         action = "none"
         if self.state == "idle":
@@ -621,7 +2039,7 @@ class CheckExit():
             if not self.door_open:
                 self.state = "check_went_out"
         elif self.state == "check_went_out":
-            t = time.time()
+            t = now
             if t - self.door_close_time > DOOR_CLOSE_TO_IN_PIR_TIME:
                 if self.inside_pir_on or t - self.inside_pir_off_time < DOOR_CLOSE_TO_IN_PIR_TIME - 4:
                     action = "answered_door"
@@ -633,16 +2051,16 @@ class CheckExit():
             if self.inside_pir_on:
                 action = "came_in"
                 self.state = "wait_door_close"
-            elif time.time() - self.door_open_time > DOOR_OPEN_TO_IN_PIR_TIME:
+            elif now - self.door_open_time > DOOR_OPEN_TO_IN_PIR_TIME:
                 action = "open_and_close"
                 self.state = "wait_door_close"
         elif self.state == "wait_door_close":
             if not self.door_open:
                 self.state = "idle"
-            elif time.time() - self.door_open_time > MAX_DOOR_OPEN_TIME:
+            elif now - self.door_open_time > MAX_DOOR_OPEN_TIME:
                 action = "door_open_too_long"
                 self.state = "wait_long_door_open"
-        elif self.state == "wait_door_close":
+        elif self.state == "wait_long_door_open":
             if not self.door_open:
                 self.state = "idle"
         else:
@@ -655,29 +2073,83 @@ class CheckExit():
             self.dm.storeEntryExit(self.location, self.door_open_time, action, 0)
             self.dm.storeEntryExit(self.location, self.door_open_time + 1, action, 1)
             self.dm.storeEntryExit(self.location, self.door_open_time + 2, action, 0)
-        reactor.callLater(1, self.fsm)
+
+def loadConfig(cbLog):
+    """ Updates config from sch_app.config """
+    global config
+    configFile = CB_CONFIG_DIR + "sch_app.config"
+    try:
+        with open(configFile, 'r') as f:
+            newConfig = json.load(f)
+            cbLog("debug", "Read sch_app.config")
+            config.update(newConfig)
+    except Exception as ex:
+        cbLog("warning", "sch_app.config does not exist or file is corrupt")
+        cbLog("warning", "Exception: " + str(type(ex)) + str(ex.args))
+    for c in config:
+        if c.lower in ("true", "t", "1"):
+            config[c] = True
+        elif c.lower in ("false", "f", "0"):
+            config[c] = False
+    cbLog("debug", "Config: " + str(config))
+
+def startUploads(cbLog, spoolName):
+    """ Starts the timers, uploader and spool that are shared by everything in the process """
+    timers.cbLog = cbLog
+    timers.setResolution(config["timer_resolution"])
+    timers.callLater(config["timer_report_interval"], timers.report)
+    uploader = Uploader(config["upload_workers"])
+    uploader.cbLog = cbLog
+    spool = None
+    try:
+        spool = Spool(CB_CONFIG_DIR + spoolName)
+        spool.cbLog = cbLog
+        spool.uploader = uploader
+        if spool.count > 0:
+            cbLog("info", "Spool has " + str(spool.count) + " posts to send")
+    except Exception as ex:
+        cbLog("warning", "Could not open spool. Unsent values will be kept in memory")
+        cbLog("warning", "Exception: " + str(type(ex)) + str(ex.args))
+    def uploadStats():
+        stats = {"active": uploader.active,
+                 "queued": len(uploader.queue),
+                 "events_active": uploader.eventActive,
+                 "events_queued": len(uploader.eventQueue),
+                 "breakers_open": [b.endpoint for b in uploader.breakers.values() if b.isOpen()]}
+        if spool:
+            stats["spooled_posts"] = spool.count
+            stats["spool_bytes"] = spool.size
+        return stats
+    metrics.addSource("uploads", uploadStats)
+    return uploader, spool
+
+def serveMetrics(port, cbLog):
+    if port:
+        try:
+            reactor.listenTCP(port, server.Site(MetricsResource()), interface="127.0.0.1")
+        except Exception as ex:
+            cbLog("warning", "Could not serve metrics on port " + str(port))
+            cbLog("warning", "Exception: " + str(type(ex)) + str(ex.args))
 
 class App(CbApp):
     def __init__(self, argv):
         self.appClass = "monitor"
         self.state = "stopped"
         self.status = "ok"
-        self.accel = []
-        self.gyro = []
-        self.magnet = []
-        self.temp = []
-        self.irTemp = []
-        self.buttons = []
-        self.humidity = []
-        self.binary = []
-        self.luminance = []
-        self.power = []
-        self.battery = []
-        self.connected = []
+        self.processors = []
         self.devices = []
         self.devServices = [] 
         self.idToName = {} 
+        self.friendlyNames = {}
         self.entryExitIDs = []
+        self.uploader = None
+        self.spool = None
+        self.client = None
+        self.sharedData = None  # DataManager shared with other bridges in gateway mode
+        self.history = None
+        self.trace = None
+        self.routes = {}  # (adaptor id, characteristic) -> list of handlers
+        self.pillboxes = {}  # adaptor id -> Pillbox
         #CbApp.__init__ MUST be called
         CbApp.__init__(self, argv)
 
@@ -691,160 +2163,83 @@ class App(CbApp):
                "state": self.state}
         self.sendManagerMessage(msg)
 
+    def recordTrace(self, type, message):
+        """ Appends a message to the trace file in the format replayed by sch_replay.py """
+        self.trace.write(json.dumps({"t": round(time.time() - self.traceStart, 3), "type": type, "message": message}) + "\n")
+
+    def sendMetrics(self):
+        msg = {"id": self.id,
+               "status": "metrics",
+               "metrics": metrics.getStats()}
+        self.sendManagerMessage(msg)
+        timers.callLater(config["metrics_interval"], self.sendMetrics)
+
     def onConcMessage(self, message):
         self.client.receive(message)
 
     def onAdaptorData(self, message):
         """
-        This method is called in a thread by cbcommslib so it will not cause
-        problems if it takes some time to complete (other than to itself).
+        This method is called in a thread by cbcommslib. The message is handled in the
+        reactor thread, as the processors, timers, uploader and spool are not thread safe.
         """
         #self.cbLog("debug", "onadaptorData, message: " + str(message))
-        if message["characteristic"] == "acceleration":
-            for a in self.accel:
-                if a.id == self.idToName[message["id"]]: 
-                    a.processAccel(message)
-                    break
-        elif message["characteristic"] == "temperature":
-            for t in self.temp:
-                if t.id == self.idToName[message["id"]]:
-                    t.processTemp(message)
-                    break
-        elif message["characteristic"] == "ir_temperature":
-            for t in self.irTemp:
-                if t.id == self.idToName[message["id"]]:
-                    t.processIrTemp(message)
-                    break
-        elif message["characteristic"] == "gyro":
-            for g in self.gyro:
-                if g.id == self.idToName[message["id"]]:
-                    g.processGyro(message)
-                    break
-        elif message["characteristic"] == "magnetometer":
-            for g in self.magnet:
-                if g.id == self.idToName[message["id"]]:
-                    g.processMagnet(message)
-                    break
-        elif message["characteristic"] == "buttons":
-            for b in self.buttons:
-                if b.id == self.idToName[message["id"]]:
-                    b.processButtons(message)
-                    break
-        elif message["characteristic"] == "humidity":
-            for b in self.humidity:
-                if b.id == self.idToName[message["id"]]:
-                    b.processHumidity(message)
-                    break
-        elif message["characteristic"] == "binary_sensor":
-            for b in self.binary:
-                if b.id == self.idToName[message["id"]]:
-                    b.processBinary(message)
-                    break
-            for n in self.entryExitIDs:
-                if n == message["id"]:
-                    self.entryExit.onChange(message["id"], message["timeStamp"], message["data"])
-            for n in config["night_sensors"]:
-                if n == message["id"]:
-                    self.nightWander.onChange(message["id"], message["timeStamp"], message["data"])
-        elif message["characteristic"] == "power":
-            for b in self.power:
-                if b.id == self.idToName[message["id"]]:
-                    b.processPower(message)
-                    break
-        elif message["characteristic"] == "battery":
-            for b in self.battery:
-                if b.id == self.idToName[message["id"]]:
-                    b.processBattery(message)
-                    break
-        elif message["characteristic"] == "connected":
-            for b in self.connected:
-                if b.id == self.idToName[message["id"]]:
-                    b.processConnected(message)
-                    break
-        elif message["characteristic"] == "luminance":
-            for b in self.luminance:
-                if b.id == self.idToName[message["id"]]:
-                    b.processLuminance(message)
-                    break
+        if not clock.isInIOThread():
+            clock.callFromThread(self.onAdaptorData, message)
+            return
+        if self.trace:
+            self.recordTrace("data", message)
+        metrics.count("messages", message["characteristic"])
+        try:
+            handlers = self.routes[(message["id"], message["characteristic"])]
+        except KeyError:
+            return
+        for h in handlers:
+            h(message)
+
+    def onBinaryEvent(self, message):
+        if message["id"] in self.entryExitIDs:
+            self.entryExit.onChange(message["id"], message["timeStamp"], message["data"])
+        if message["id"] in self.nightWander.sensors:
+            self.nightWander.onChange(message["id"], message["timeStamp"], message["data"])
 
     def onAdaptorService(self, message):
         #self.cbLog("debug", "onAdaptorService, message: " + str(message))
+        if self.trace:
+            self.recordTrace("service", message)
         self.devServices.append(message)
         serviceReq = []
         for p in message["service"]:
             # Based on services offered & whether we want to enable them
-            if p["characteristic"] == "temperature":
-                if config["temperature"] == 'True':
-                    self.temp.append(TemperatureMeasure((self.idToName[message["id"]])))
-                    self.temp[-1].dm = self.dm
-                    serviceReq.append({"characteristic": "temperature",
-                                       "interval": config["slow_polling_interval"]})
-            elif p["characteristic"] == "ir_temperature":
-                if config["irtemperature"] == 'True':
-                    self.irTemp.append(IrTemperatureMeasure(self.idToName[message["id"]]))
-                    self.irTemp[-1].dm = self.dm
-                    serviceReq.append({"characteristic": "ir_temperature",
-                                       "interval": config["slow_polling_interval"]})
-            elif p["characteristic"] == "acceleration":
-                if config["accel"] == 'True':
-                    self.accel.append(Accelerometer((self.idToName[message["id"]])))
-                    serviceReq.append({"characteristic": "acceleration",
-                                       "interval": config["accel_polling_interval"]})
-                    self.accel[-1].dm = self.dm
-            elif p["characteristic"] == "gyro":
-                if config["gyro"] == 'True':
-                    self.gyro.append(Gyro(self.idToName[message["id"]]))
-                    self.gyro[-1].dm = self.dm
-                    serviceReq.append({"characteristic": "gyro",
-                                       "interval": config["gyro_polling_interval"]})
-            elif p["characteristic"] == "magnetometer":
-                if config["magnet"] == 'True': 
-                    self.magnet.append(Magnet(self.idToName[message["id"]]))
-                    self.magnet[-1].dm = self.dm
-                    serviceReq.append({"characteristic": "magnetometer",
-                                       "interval": config["magnet_polling_interval"]})
-            elif p["characteristic"] == "buttons":
-                if config["buttons"] == 'True':
-                    self.buttons.append(Buttons(self.idToName[message["id"]]))
-                    self.buttons[-1].dm = self.dm
-                    serviceReq.append({"characteristic": "buttons",
-                                       "interval": 0})
-            elif p["characteristic"] == "humidity":
-                if config["humidity"] == 'True':
-                    self.humidity.append(Humid(self.idToName[message["id"]]))
-                    self.humidity[-1].dm = self.dm
-                    serviceReq.append({"characteristic": "humidity",
-                                       "interval": config["slow_polling_interval"]})
-            elif p["characteristic"] == "binary_sensor":
-                if config["binary"] == 'True':
-                    self.binary.append(Binary(self.idToName[message["id"]]))
-                    self.binary[-1].dm = self.dm
-                    serviceReq.append({"characteristic": "binary_sensor",
-                                       "interval": 0})
-            elif p["characteristic"] == "power":
-                if config["power"] == 'True':
-                    self.power.append(Power(self.idToName[message["id"]]))
-                    self.power[-1].dm = self.dm
-                    serviceReq.append({"characteristic": "power",
-                                       "interval": 0})
-            elif p["characteristic"] == "battery":
-                if config["battery"] == 'True':
-                    self.battery.append(Battery(self.idToName[message["id"]]))
-                    self.battery[-1].dm = self.dm
-                    serviceReq.append({"characteristic": "battery",
-                                       "interval": 0})
-            elif p["characteristic"] == "connected":
-                if config["connected"] == 'True':
-                    self.connected.append(Connected(self.idToName[message["id"]]))
-                    self.connected[-1].dm = self.dm
-                    serviceReq.append({"characteristic": "connected",
-                                       "interval": 0})
-            elif p["characteristic"] == "luminance":
-                if config["luminance"] == 'True':
-                    self.luminance.append(Luminance(self.idToName[message["id"]]))
-                    self.luminance[-1].dm = self.dm
-                    serviceReq.append({"characteristic": "luminance",
-                                       "interval": 0})
+            c = p["characteristic"]
+            if not c in SENSORS:
+                continue
+            handlers = []
+            if config[SENSORS[c]["enable"]] == 'True':
+                processor = makeProcessor(self.dm, self.idToName[message["id"]], c)
+                self.processors.append(processor)
+                handlers.append(processor.process)
+                if c == "binary_sensor" and (message["id"] in self.entryExitIDs or message["id"] in self.nightWander.sensors):
+                    handlers.append(self.onBinaryEvent)
+            if config["pillbox"] == "True" and config["pillbox_sensors"].get(self.friendlyNames.get(message["id"])) in (c, SENSORS[c]["enable"]):
+                # An adaptor may send its services again, so its pillbox and the timers at the ends of its windows are kept
+                if not message["id"] in self.pillboxes:
+                    self.pillboxes[message["id"]] = Pillbox(self.dm, self.idToName[message["id"]], self.friendlyNames[message["id"]],
+                                                            self.id, self.client)
+                handlers.append(self.pillboxes[message["id"]].process)
+            if handlers:
+                self.routes[(message["id"], c)] = handlers
+                interval = SENSORS[c]["interval"]
+                serviceReq.append({"characteristic": c,
+                                   "interval": config[interval] if interval else 0})
+        for req in serviceReq:
+            c = req["characteristic"]
+            if c in config["rollups"]:
+                rollup = RollupStage(self.dm, self.idToName[message["id"]], c, config["rollups"][c])
+                handlers = self.routes[(message["id"], c)]
+                if c in config["rollup_only"]:
+                    # Raw values are not sent, but entry/exit, night wandering and the pillbox still need them
+                    handlers = [h for h in handlers if not isinstance(getattr(h, "__self__", None), Processor)]
+                self.routes[(message["id"], c)] = [rollup.process] + handlers
         msg = {"id": self.id,
                "request": "service",
                "service": serviceReq}
@@ -852,22 +2247,17 @@ class App(CbApp):
         self.setState("running")
 
     def onConfigureMessage(self, managerConfig):
-        global config
-        configFile = CB_CONFIG_DIR + "sch_app.config"
-        try:
-            with open(configFile, 'r') as f:
-                newConfig = json.load(f)
-                self.cbLog("debug", "Read sch_app.config")
-                config.update(newConfig)
-        except Exception as ex:
-            self.cbLog("warning", "sch_app.config does not exist or file is corrupt")
-            self.cbLog("warning", "Exception: " + str(type(ex)) + str(ex.args))
-        for c in config:
-            if c.lower in ("true", "t", "1"):
-                config[c] = True
-            elif c.lower in ("false", "f", "0"):
-                config[c] = False
-        self.cbLog("debug", "Config: " + str(config))
+        loadConfig(self.cbLog)
+        if config["trace_file"] and not self.trace:
+            try:
+                self.trace = open(os.path.join(CB_CONFIG_DIR, config["trace_file"]), "a", 1)
+                self.traceStart = time.time()
+                self.recordTrace("config", {k: config[k] for k in config if not k in TRACE_OMITTED})
+            except Exception as ex:
+                self.cbLog("warning", "Could not open trace file " + config["trace_file"])
+                self.cbLog("warning", "Exception: " + str(type(ex)) + str(ex.args))
+        if self.trace:
+            self.recordTrace("configure", managerConfig)
         idToName2 = {}
         for adaptor in managerConfig["adaptors"]:
             adtID = adaptor["id"]
@@ -877,13 +2267,37 @@ class App(CbApp):
                 friendly_name = adaptor["friendly_name"]
                 self.cbLog("debug", "managerConfigure app. Adaptor id: " +  adtID + " name: " + name + " friendly_name: " + friendly_name)
                 idToName2[adtID] = friendly_name
+                self.friendlyNames[adtID] = friendly_name
                 self.idToName[adtID] = friendly_name.replace(" ", "_")
                 self.devices.append(adtID)
-        self.dm = DataManager(self.bridge_id)
-        self.dm.cbLog = self.cbLog
-        self.client = Client(self.bridge_id)
-        self.client.sendMessage = self.sendMessage
-        self.client.cbLog = self.cbLog
+        if not self.uploader:
+            self.uploader, self.spool = startUploads(self.cbLog, "sch_app_spool.db")
+            if config["metrics_interval"] > 0:
+                timers.callLater(config["metrics_interval"], self.sendMetrics)
+            serveMetrics(config["metrics_port"], self.cbLog)
+        if not self.client:
+            # Created once, so that messages awaiting an ack survive reconfiguration
+            self.client = Client(self.bridge_id)
+            self.client.sendMessage = self.sendMessage
+            self.client.cbLog = self.cbLog
+            if not self.sharedData:
+                # In gateway mode the worker adds up the clients of all its bridges
+                metrics.addSource("client", self.client.getStats)
+        if self.sharedData:
+            self.dm = BridgeData(self.sharedData, self.bridge_id)
+        else:
+            self.dm = DataManager(self.bridge_id)
+            self.dm.cbLog = self.cbLog
+            self.dm.uploader = self.uploader
+            self.dm.spool = self.spool
+            metrics.addSource("queue_depth", self.dm.queueDepths)
+        if config["history"] == "True" and not self.history:
+            # Kept through reconfiguration, like the client
+            self.history = History()
+            histories[self.bridge_id] = self.history
+            if not self.sharedData:
+                metrics.addSource("history", self.history.getStats)
+        self.dm.history = self.history
         self.entryExit = EntryExit()
         self.entryExit.cbLog = self.cbLog
         self.entryExit.dm = self.dm
@@ -892,7 +2306,7 @@ class App(CbApp):
         self.nightWander = NightWander(self.id)
         self.nightWander.cbLog = self.cbLog
         self.nightWander.client = self.client
-        self.nightWander.setNames(idToName2)
+        self.nightWander.setNames(self.friendlyNames)
         self.setState("starting")
 
 if __name__ == '__main__':
@@ -0,0 +1,290 @@
+#!/usr/bin/env python
+# sch_bench.py
+# Copyright (C) ContinuumBridge Limited, 2014 - All Rights Reserved
+# Unauthorized copying of this file, via any medium is strictly prohibited
+# Proprietary and confidential
+# Written by Peter Claydon
+#
+"""
+Micro-benchmarks for parts of the SCH app, run without a bridge. Usage:
+
+    sch_bench.py compression [trace]
+                             Points sent and largest reconstruction error of deadband
+                             and swinging-door compression, on generated temperature,
+                             power and luminance series or on the scalar series of a
+                             trace recorded by the app
+    sch_bench.py dispatch    Messages per second through App.onAdaptorData with 10,
+                             100 and 1000 devices
+    sch_bench.py encoding    Body size and encoding time of a post with plain SenML and
+                             with SenML base fields, each with and without gzip
+    sch_bench.py memory      Bytes per buffered 3-axis sample in DataManager, against
+                             the dict per sample that it used to hold
+    sch_bench.py motion      3-axis readings per second through MotionBlock on one core,
+                             quiet and busy, by motion_block_size and motion_stats
+    sch_bench.py pillbox     Cost per magnetometer reading of the pillbox detector
+                             as its window grows, against re-summing the window
+"""
+import sys
+import time
+import math
+import json
+import zlib
+import bisect
+import random
+import collections
+import tracemalloc
+import sch_replay  # Installs the stand-ins for the bridge libraries
+import sch_app_a
+from twisted.python import threadable
+
+# The benches run in this thread without a reactor, so the app must treat it as the reactor thread
+threadable.registerAsIOThread()
+
+class NullDataManager():
+    def storeValue(self, deviceID, name, timeStamp, value, da=False, event=False):
+        pass
+
+    def hold(self, deviceID, block):
+        pass
+
+class NullSharedData():
+    """ In place of the DataManager that BridgeData stores through, so that nothing is posted """
+    baseurl = ""
+    daurl = ""
+
+    def queueValue(self, url, name, timeStamp, value):
+        pass
+
+    queueEvent = queueValue
+
+class RecordingDataManager():
+    def __init__(self):
+        self.points = []
+
+    def storeValue(self, deviceID, name, timeStamp, value, da=False, event=False):
+        self.points.append((timeStamp, value))
+
+def generatedSeries():
+    """ Three days of readings every minute """
+    rnd = random.Random(1)
+    times = [1400000000.0 + 60*i for i in range(3*24*60)]
+    day = 2*math.pi/86400
+    temperature = [20 + 2*math.sin(day*t) + rnd.gauss(0, 0.05) for t in times]
+    power = []
+    level = 0.0
+    for t in times:
+        if rnd.random() < 0.01:
+            level = rnd.choice((0.0, 5.0, 60.0, 1500.0))
+        power.append(level + rnd.gauss(0, 0.3))
+    luminance = [max(0.0, 500*math.sin(day*t)) + rnd.gauss(0, 0.5) for t in times]
+    return [("temperature", times, temperature), ("power", times, power), ("luminance", times, luminance)]
+
+SCALARS = [c for c in sch_app_a.SENSORS if sch_app_a.SENSORS[c]["processor"] in (sch_app_a.Deadband, sch_app_a.StepDeadband)]
+
+def recordedSeries(fileName):
+    """ Each series of a characteristic that Deadband or StepDeadband would handle """
+    traceConfig, events = sch_replay.readTrace(fileName)
+    sch_app_a.config.update(traceConfig)
+    series = {}
+    for t, type, message in events:
+        if type == "data" and message["characteristic"] in SCALARS:
+            times, values = series.setdefault((message["characteristic"], message["id"]), ([], []))
+            times.append(message["timeStamp"])
+            values.append(message["data"])
+    return [(c, series[(c, id)][0], series[(c, id)][1]) for c, id in sorted(series)]
+
+def maxError(points, times, values, interpolate):
+    """
+    The largest difference between a reading and the series drawn from the points
+    sent, joined by straight lines or as steps, from the first to the last point
+    """
+    pointTimes = [p[0] for p in points]
+    error = 0.0
+    for t, v in zip(times, values):
+        i = bisect.bisect_right(pointTimes, t) - 1
+        if i < 0 or t > pointTimes[-1]:
+            continue
+        t0, v0 = points[i]
+        if interpolate and i + 1 < len(points):
+            t1, v1 = points[i + 1]
+            v0 += (v1 - v0)*(t - t0)/(t1 - t0)
+        error = max(error, abs(v - v0))
+    return error
+
+def benchCompression(fileName=None):
+    """ The series of each characteristic are added up, eg. for every device in a trace """
+    if fileName:
+        series = recordedSeries(fileName)
+    else:
+        series = generatedSeries()
+    results = collections.OrderedDict()  # (characteristic, compression) -> [readings, points, max error]
+    for characteristic, times, values in series:
+        spec = sch_app_a.SENSORS[characteristic]
+        for compression in ("deadband", "swinging_door"):
+            sch_app_a.config[spec["config"] + "_compression"] = compression
+            dm = RecordingDataManager()
+            processor = sch_app_a.makeProcessor(dm, "ADT0", characteristic)
+            for t, v in zip(times, values):
+                processor.process({"timeStamp": t, "data": v})
+            points = sorted(dm.points)
+            result = results.setdefault((characteristic, compression), [0, 0, 0.0])
+            result[0] += len(times)
+            result[1] += len(points)
+            if points:
+                result[2] = max(result[2], maxError(points, times, values, compression == "swinging_door"))
+    sys.stdout.write("%14s %10s %8s %14s %8s %10s\n" % ("series", "tolerance", "readings", "compression", "points", "max error"))
+    for (characteristic, compression), (readings, points, error) in results.items():
+        tolerance = sch_app_a.config[sch_app_a.SENSORS[characteristic]["config"] + "_min_change"]
+        sys.stdout.write("%14s %10s %8d %14s %8d %10.2f\n" % (characteristic, tolerance, readings, compression, points, error))
+
+def benchDispatch():
+    """ Temperature messages spread over every device, each changing by more than the deadband so that it is stored """
+    with open(sch_replay.cbconfig.CB_CONFIG_DIR + "sch_app.config", "w") as f:
+        json.dump({"temperature": "True", "temp_min_change": 0.2}, f)
+    n = 30000
+    sys.stdout.write("%8s %12s\n" % ("devices", "messages/s"))
+    for devices in (10, 100, 1000):
+        app = sch_app_a.App(["sch_bench"])
+        app.sharedData = NullSharedData()
+        app.onConfigureMessage({"adaptors": [{"id": "ADT%d" % d, "name": "sensortag", "friendly_name": "Sensor %d" % d}
+                                             for d in range(devices)]})
+        for d in range(devices):
+            app.onAdaptorService({"id": "ADT%d" % d, "service": [{"characteristic": "temperature", "interval": 300},
+                                                                 {"characteristic": "humidity", "interval": 300}]})
+        messages = [{"id": "ADT%d" % (i % devices), "characteristic": "temperature", "timeStamp": 1000.0 + i,
+                     "data": 20.0 + 0.5*((i//devices) % 2)} for i in range(n)]
+        start = time.time()
+        for message in messages:
+            app.onAdaptorData(message)
+        sys.stdout.write("%8d %12.0f\n" % (devices, n/(time.time() - start)))
+
+def batch(devices, readings):
+    """ The values of a batched post of 3-axis readings from each device, named as storeValue names them """
+    rnd = random.Random(1)
+    values = []
+    for d in range(devices):
+        for i in range(readings):
+            t = 1400000000.0 + i*0.1
+            for axis in ("accel_x", "accel_y", "accel_z"):
+                values.append({"n":"ADT%d/%s" % (d, axis), "v":round(rnd.gauss(0, 1), 3), "t":t})
+    return values
+
+def benchEncoding():
+    sys.stdout.write("%8s %8s %12s %8s %8s %12s\n" % ("devices", "values", "encoding", "gzip", "bytes", "us/post"))
+    for devices in (1, 20):
+        values = batch(devices, 7)
+        for encoding in ("senml", "senml_base"):
+            sch_app_a.config["upload_encoding"] = encoding
+            for gzip in (False, True):
+                n = 2000
+                start = time.time()
+                for i in range(n):
+                    body = sch_app_a.encodeValues(values)
+                    if gzip:
+                        # As Uploader.post compresses bodies
+                        compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+                        body = compressor.compress(body.encode()) + compressor.flush()
+                elapsed = time.time() - start
+                sys.stdout.write("%8d %8d %12s %8s %8d %12.1f\n" % (devices, len(values), encoding, gzip, len(body), elapsed/n*1e6))
+
+def storeDicts(s, url, deviceID, timeStamp, a):
+    """ How samples were buffered before DataManager kept arrays: a dict for each value """
+    for name, v in zip(("accel_x", "accel_y", "accel_z"), a):
+        s.setdefault(url, []).append({"n":deviceID + "/" + name, "v":v, "t":timeStamp})
+
+def benchMemory():
+    n = 30000
+    rnd = random.Random(1)
+    samples = [(1000.0 + i*0.1, (rnd.gauss(0, 1), rnd.gauss(0, 1), rnd.gauss(1, 1))) for i in range(n)]
+    sch_app_a.config["batch_upload"] = "True"
+    sch_app_a.config["batch_max_values"] = 4*n  # So that nothing is flushed
+    sys.stdout.write("%12s %14s\n" % ("layout", "bytes/sample"))
+    tracemalloc.start()
+    start = tracemalloc.get_traced_memory()[0]
+    s = {}
+    for t, a in samples:
+        storeDicts(s, "url", "ADT0", t, a)
+    dicts = tracemalloc.get_traced_memory()[0] - start
+    del s
+    start = tracemalloc.get_traced_memory()[0]
+    dm = sch_app_a.DataManager("BID0")
+    for t, a in samples:
+        for name, v in zip(("accel_x", "accel_y", "accel_z"), a):
+            dm.storeValue("ADT0", name, t, v)
+    arrays = tracemalloc.get_traced_memory()[0] - start
+    tracemalloc.stop()
+    sys.stdout.write("%12s %14.1f\n" % ("dicts", dicts/(3.0*n)))
+    sys.stdout.write("%12s %14.1f\n" % ("arrays", arrays/(3.0*n)))
+
+def benchMotion():
+    n = 65536
+    rnd = random.Random(1)
+    # The sensor still, and moving by more than accel_min_change at almost every reading
+    quiet = [{"timeStamp": 1000.0 + i*0.1, "data": {"x": rnd.gauss(0, 0.005), "y": rnd.gauss(0, 0.005), "z": rnd.gauss(1, 0.005)}}
+             for i in range(n)]
+    busy = [{"timeStamp": 1000.0 + i*0.1, "data": {"x": rnd.gauss(0, 0.5), "y": rnd.gauss(0, 0.5), "z": rnd.gauss(1, 0.5)}}
+            for i in range(n)]
+    sys.stdout.write("%8s %8s %8s %12s\n" % ("readings", "block", "stats", "readings/s"))
+    for name, samples in (("quiet", quiet), ("busy", busy)):
+        for stats in ("False", "True"):
+            for blockSize in (1, 16, 64):
+                sch_app_a.config["motion_block_size"] = blockSize
+                sch_app_a.config["motion_stats"] = stats
+                processor = sch_app_a.makeProcessor(NullDataManager(), "ADT0", "acceleration")
+                start = time.time()
+                for resp in samples:
+                    processor.process(resp)
+                processor.flush()
+                sys.stdout.write("%8s %8d %8s %12.0f\n" % (name, blockSize, stats, n/(time.time() - start)))
+
+def readings(n):
+    rnd = random.Random(1)
+    return [{"timeStamp": 1000.0 + i, "data": {"x": rnd.gauss(30, 0.3), "y": rnd.gauss(10, 0.3), "z": rnd.gauss(-20, 0.3)}}
+            for i in range(n)]
+
+def naiveProcess(window, data):
+    """ The detector's test with the statistics worked out again from the whole window """
+    m = math.sqrt(data["x"]**2 + data["y"]**2 + data["z"]**2)
+    if len(window) == window.size:
+        mean = sum(window)/len(window)
+        sd = math.sqrt(sum((v - mean)**2 for v in window)/len(window))
+        abs(m - mean) > 4.0*sd + 1.5
+        window.pop(0)
+    window.append(m)
+
+class Window(list):
+    pass
+
+def benchPillbox():
+    sizes = (16, 64, 256, 1024, 4096, 16384)
+    samples = readings(max(sizes) + 20000)
+    sys.stdout.write("%8s %16s %16s\n" % ("window", "rolling us/rd", "re-summing us/rd"))
+    for size in sizes:
+        # Both are timed once their windows are full
+        sch_app_a.config["pillbox_window"] = size
+        sch_app_a.config["pillbox_start"] = ["00:00"]
+        sch_app_a.config["pillbox_end"] = ["23:59"]
+        pillbox = sch_app_a.Pillbox(NullDataManager(), "box", "box", "AID0", None)
+        for resp in samples[:size]:
+            pillbox.process(resp)
+        start = time.time()
+        for resp in samples[size:size + 20000]:
+            pillbox.process(resp)
+        rolling = (time.time() - start)/20000*1e6
+        window = Window()
+        window.size = size
+        for resp in samples[:size]:
+            naiveProcess(window, resp["data"])
+        n = max(100, min(20000, 2000000//size))
+        start = time.time()
+        for resp in samples[size:size + n]:
+            naiveProcess(window, resp["data"])
+        naive = (time.time() - start)/n*1e6
+        sys.stdout.write("%8d %16.2f %16.2f\n" % (size, rolling, naive))
+
+if __name__ == '__main__':
+    benches = {"compression": benchCompression, "dispatch": benchDispatch, "encoding": benchEncoding, "memory": benchMemory, "motion": benchMotion, "pillbox": benchPillbox}
+    if len(sys.argv) < 2 or sys.argv[1] not in benches:
+        sys.stdout.write(__doc__)
+        sys.exit(1)
+    benches[sys.argv[1]](*sys.argv[2:])
@@ -0,0 +1,250 @@
+#!/usr/bin/env python
+# sch_gateway.py
+# Copyright (C) ContinuumBridge Limited, 2014 - All Rights Reserved
+# Unauthorized copying of this file, via any medium is strictly prohibited
+# Proprietary and confidential
+# Written by Peter Claydon
+#
+"""
+Runs the SCH app on a server for many bridges at once. Bridges are sharded by
+bridge id across a number of worker processes. Each worker runs one App per bridge,
+so every bridge has its own processors, entry/exit and night wandering state, and
+all the bridges in a worker share one uploader, spool and batch, so their values
+are posted together.
+
+Bridges, or a relay in front of them, connect over TCP and send JSON lines:
+
+    {"bridge": "BID12", "type": "configure", "message": {...}, "app": "AID3"}
+    {"bridge": "BID12", "type": "service", "message": {...}}
+    {"bridge": "BID12", "type": "data", "message": {...}}
+    {"bridge": "BID12", "type": "conc", "message": {...}}
+
+which are passed to onConfigureMessage, onAdaptorService, onAdaptorData and
+onConcMessage of that bridge's App. A bridge must be configured first. Messages
+from the App are sent back on the connection that the bridge last used:
+
+    {"bridge": "BID12", "destination": "ADT3", "message": {...}}
+    {"bridge": "BID12", "destination": "manager", "message": {...}}
+
+Connections are not authenticated, so by default only local ones are accepted, on
+127.0.0.1. Bridges elsewhere must connect through a relay on this host that
+authenticates them, eg. over TLS with client certificates, and only forwards the
+messages of the bridges that each is allowed to send for.
+
+sch_app.config is read from --config-dir and applies to every bridge. Usage:
+
+    sch_gateway.py --port 5020 --shards 4 --config-dir /opt/cbridge/gateway/
+"""
+import sys
+import os
+import json
+import zlib
+import types
+import argparse
+from twisted.internet import reactor, protocol, stdio
+from twisted.protocols.basic import LineReceiver
+
+MAX_LINE = 1048576
+GATEWAY_CONFIG = {"batch_upload": "True"}  # Values for all bridges in a shard are posted together
+
+def shardOf(bridge, shards):
+    # crc32 rather than hash(), which is not the same in every process
+    return zlib.crc32(bridge.encode("utf-8")) % shards
+
+class WorkerProtocol(protocol.ProcessProtocol):
+    def __init__(self, gateway, shard):
+        self.gateway = gateway
+        self.shard = shard
+        self.buffer = b""
+
+    def outReceived(self, data):
+        lines = (self.buffer + data).split(b"\n")
+        self.buffer = lines.pop()
+        for line in lines:
+            self.gateway.fromWorker(line)
+
+    def errReceived(self, data):
+        sys.stderr.write(data.decode("utf-8", "replace"))
+
+    def processEnded(self, reason):
+        self.gateway.workerEnded(self.shard, reason)
+
+class BridgeProtocol(LineReceiver):
+    delimiter = b"\n"
+    MAX_LENGTH = MAX_LINE
+
+    def lineReceived(self, line):
+        try:
+            bridge = json.loads(line.decode("utf-8"))["bridge"]
+        except Exception as ex:
+            sys.stderr.write("gateway warning: bad line from " + str(self.transport.getPeer()) + ": " + str(ex) + "\n")
+            return
+        self.factory.gateway.toWorker(bridge, line, self)
+
+class Gateway():
+    """ Passes lines between bridge connections and the worker for each bridge """
+    def __init__(self, args):
+        self.args = args
+        self.workers = [None]*args.shards
+        self.connections = {}  # bridge id -> BridgeProtocol that it last sent on
+        self.stopping = False
+
+    def start(self):
+        for shard in range(self.args.shards):
+            self.spawn(shard)
+        factory = protocol.ServerFactory()
+        factory.protocol = BridgeProtocol
+        factory.gateway = self
+        reactor.listenTCP(self.args.port, factory, interface=self.args.interface)
+        reactor.addSystemEventTrigger("before", "shutdown", self.stop)
+
+    def spawn(self, shard):
+        args = [sys.executable, os.path.abspath(__file__), "--worker", str(shard), "--config-dir", self.args.config_dir]
+        if self.args.verbose:
+            args.append("--verbose")
+        self.workers[shard] = WorkerProtocol(self, shard)
+        reactor.spawnProcess(self.workers[shard], sys.executable, args, env=os.environ)
+
+    def stop(self):
+        # Closing stdin stops a worker, after its spool has been committed
+        self.stopping = True
+        for worker in self.workers:
+            if worker.transport:
+                worker.transport.closeStdin()
+
+    def toWorker(self, bridge, line, connection):
+        self.connections[bridge] = connection
+        self.workers[shardOf(bridge, self.args.shards)].transport.write(line + b"\n")
+
+    def fromWorker(self, line):
+        bridge = json.loads(line.decode("utf-8"))["bridge"]
+        connection = self.connections.get(bridge)
+        if connection and connection.transport.connected:
+            connection.sendLine(line)
+
+    def workerEnded(self, shard, reason):
+        if not self.stopping:
+            # The bridges in this shard have lost their state and must be configured again
+            sys.stderr.write("gateway error: worker " + str(shard) + " ended: " + str(reason.value) + ", restarting\n")
+            self.spawn(shard)
+
+class CbApp(object):
+    """ Stands in for cbcommslib.CbApp in a worker. Messages from the App are passed back to the gateway. """
+    worker = None
+
+    def __init__(self, argv):
+        self.bridge_id = argv[1]
+        self.id = argv[2]
+
+    def sendMessage(self, msg, dest):
+        self.worker.send(self.bridge_id, dest, msg)
+
+    def sendManagerMessage(self, msg):
+        self.worker.send(self.bridge_id, "manager", msg)
+
+    def cbLog(self, level, msg):
+        self.worker.cbLog(level, self.bridge_id + ": " + msg)
+
+class Worker(LineReceiver):
+    """ Runs the Apps for the bridges in one shard. Lines are read from stdin and written to stdout. """
+    delimiter = b"\n"
+    MAX_LENGTH = MAX_LINE
+
+    def __init__(self, shard, verbose):
+        self.shard = shard
+        self.verbose = verbose
+        self.apps = {}
+
+    def cbLog(self, level, msg):
+        if self.verbose or level != "debug":
+            sys.stderr.write("shard " + str(self.shard) + " " + level + ": " + msg + "\n")
+
+    def send(self, bridge, dest, msg):
+        self.sendLine(json.dumps({"bridge": bridge, "destination": dest, "message": msg}).encode("utf-8"))
+
+    def connectionMade(self):
+        sch_app_a.loadConfig(self.cbLog)
+        sch_app_a.config.update(GATEWAY_CONFIG)
+        self.uploader, self.spool = sch_app_a.startUploads(self.cbLog, "sch_app_spool_" + str(self.shard) + ".db")
+        self.data = sch_app_a.DataManager(None)
+        self.data.cbLog = self.cbLog
+        self.data.uploader = self.uploader
+        self.data.spool = self.spool
+        sch_app_a.metrics.addSource("queue_depth", self.data.queueDepths)
+        sch_app_a.metrics.addSource("client", self.clientStats)
+        if sch_app_a.config["metrics_port"]:
+            # One port for each shard, after metrics_port
+            sch_app_a.serveMetrics(sch_app_a.config["metrics_port"] + 1 + self.shard, self.cbLog)
+
+    def clientStats(self):
+        """ The concentrator clients of all the shard's bridges, added up """
+        stats = {"bridges": 0, "outstanding": 0, "backlog": 0}
+        for app in self.apps.values():
+            if app.client:
+                s = app.client.getStats()
+                stats["bridges"] += 1
+                stats["outstanding"] += s["outstanding"]
+                stats["backlog"] += s["backlog"]
+        return stats
+
+    def lineReceived(self, line):
+        try:
+            msg = json.loads(line.decode("utf-8"))
+            bridge = msg["bridge"]
+            if msg["type"] == "configure":
+                if not bridge in self.apps:
+                    app = sch_app_a.App(["sch_gateway", bridge, msg.get("app", "AID0")])
+                    app.uploader = self.uploader
+                    app.spool = self.spool
+                    app.sharedData = self.data
+                    self.apps[bridge] = app
+                self.apps[bridge].onConfigureMessage(msg["message"])
+                sch_app_a.config.update(GATEWAY_CONFIG)
+            elif not bridge in self.apps:
+                self.cbLog("warning", "Message for " + bridge + " before it was configured")
+            elif msg["type"] == "data":
+                self.apps[bridge].onAdaptorData(msg["message"])
+            elif msg["type"] == "service":
+                self.apps[bridge].onAdaptorService(msg["message"])
+            elif msg["type"] == "conc":
+                self.apps[bridge].onConcMessage(msg["message"])
+        except Exception as ex:
+            self.cbLog("warning", "Could not process line: " + str(type(ex)) + str(ex.args))
+
+    def connectionLost(self, reason):
+        if self.spool:
+            self.spool.db.commit()
+        # The worker may already be stopping, if it got a signal as well as the gateway
+        if reactor.running:
+            reactor.stop()
+
+def main(argv):
+    global sch_app_a
+    parser = argparse.ArgumentParser(description="Run the SCH app for many bridges")
+    parser.add_argument("--port", type=int, default=5020)
+    parser.add_argument("--interface", default="127.0.0.1",
+        help="interface to listen on, default 127.0.0.1. Connections are not authenticated")
+    parser.add_argument("--shards", type=int, default=os.sysconf("SC_NPROCESSORS_ONLN") if hasattr(os, "sysconf") else 2,
+        help="number of worker processes, default one per core")
+    parser.add_argument("--config-dir", default=".", help="directory with sch_app.config, also used for the spools")
+    parser.add_argument("--worker", type=int, help=argparse.SUPPRESS)
+    parser.add_argument("--verbose", action="store_true", help="log debug messages")
+    args = parser.parse_args(argv[1:])
+    args.config_dir = os.path.join(os.path.abspath(args.config_dir), "")
+    if args.worker is None:
+        Gateway(args).start()
+    else:
+        # The stand-ins must be in place before sch_app_a is imported
+        cbcommslib = types.ModuleType("cbcommslib")
+        cbcommslib.CbApp = CbApp
+        sys.modules["cbcommslib"] = cbcommslib
+        cbconfig = types.ModuleType("cbconfig")
+        cbconfig.CB_CONFIG_DIR = args.config_dir
+        sys.modules["cbconfig"] = cbconfig
+        import sch_app_a
+        CbApp.worker = Worker(args.worker, args.verbose)
+        stdio.StandardIO(CbApp.worker)
+    reactor.run()
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,389 @@
+#!/usr/bin/env python
+# sch_replay.py
+# Copyright (C) ContinuumBridge Limited, 2014 - All Rights Reserved
+# Unauthorized copying of this file, via any medium is strictly prohibited
+# Proprietary and confidential
+# Written by Peter Claydon
+#
+"""
+Replays a trace of adaptor messages into the SCH app without a bridge or a
+database, and reports how it performed.
+
+A trace is a file of JSON lines, as recorded by the app when "trace_file" is set
+in sch_app.config:
+
+    {"t": 0.0, "type": "config", "message": {sch_app.config values}}
+    {"t": 0.0, "type": "configure", "message": {"adaptors": [...]}}
+    {"t": 0.1, "type": "service", "message": {"id": ..., "service": [...]}}
+    {"t": 3.2, "type": "data", "message": {"id": ..., "characteristic": ..., "timeStamp": ..., "data": ...}}
+
+t is the time in seconds from the start of the trace. The app is run with a stand-in
+for cbcommslib.CbApp and posts to a local HTTP sink instead of the database. Data
+messages are given the time they are replayed as their timeStamp, so that upload
+latency can be measured.
+
+With --simulate the app is run on a simulated clock instead, with no sink or
+reactor. Messages keep their recorded timeStamps and are given to the app at the
+times they were recorded, with the app's timers run in between, as fast as
+possible. What the app stores and the alarms it sends, which are acked at once,
+can be written to a file with --output, to compare one version with another. Usage:
+
+    sch_replay.py --generate 100 --duration 600 trace.json
+    sch_replay.py [--max-speed] [--set key=value ...] trace.json
+    sch_replay.py --simulate [--output values.json] trace.json
+"""
+import sys
+import time
+import json
+import zlib
+import random
+import argparse
+import tempfile
+import shutil
+import atexit
+import types
+import resource
+
+class CbApp(object):
+    """ Stands in for cbcommslib.CbApp. Messages to the bridge are counted, not sent. """
+    def __init__(self, argv):
+        self.id = "AID0"
+        self.bridge_id = "BID0"
+        self.messagesSent = 0
+        self.verbose = False
+
+    def sendMessage(self, msg, dest):
+        self.messagesSent += 1
+
+    def sendManagerMessage(self, msg):
+        self.messagesSent += 1
+
+    def cbLog(self, level, msg):
+        if self.verbose or level in ("warning", "error"):
+            sys.stderr.write(level + ": " + msg + "\n")
+
+# The stand-ins must be in place before sch_app_a is imported
+cbcommslib = types.ModuleType("cbcommslib")
+cbcommslib.CbApp = CbApp
+sys.modules["cbcommslib"] = cbcommslib
+cbconfig = types.ModuleType("cbconfig")
+cbconfig.CB_CONFIG_DIR = tempfile.mkdtemp(prefix="sch_replay_") + "/"
+atexit.register(shutil.rmtree, cbconfig.CB_CONFIG_DIR, True)
+sys.modules["cbconfig"] = cbconfig
+
+from twisted.internet import reactor
+from twisted.web import server
+from twisted.web.resource import Resource
+import sch_app_a
+
+CHUNK = 200  # Messages replayed per reactor iteration at maximum speed
+
+class Recorder():
+    """ Stands in for the DataManager shared by the bridges in gateway mode. Records the values stored. """
+    baseurl = ""
+    daurl = ""
+
+    def __init__(self):
+        self.values = []
+
+    def queueValue(self, url, name, timeStamp, value):
+        self.values.append((timeStamp, name, value))
+
+    queueEvent = queueValue
+
+    def holdFor(self, url, block):
+        sch_app_a.timers.callLater(sch_app_a.SEND_DELAY, block.release)
+
+class Sink(Resource):
+    """ Accepts posts in place of the database and records what arrived and when """
+    isLeaf = True
+
+    def __init__(self, delay, status):
+        Resource.__init__(self)
+        self.delay = delay
+        self.status = status
+        self.posts = 0
+        self.values = 0
+        self.bytes = 0
+        self.latencies = []
+
+    def render_POST(self, request):
+        now = time.time()
+        body = request.content.read()
+        self.posts += 1
+        self.bytes += len(body)
+        if request.getHeader("content-encoding") == "gzip":
+            body = zlib.decompress(body, 31)
+        request.setResponseCode(self.status)
+        if 200 <= self.status < 300:
+            msg = json.loads(body.decode("utf-8"))
+            bt = msg.get("bt", 0)
+            for e in msg["e"]:
+                self.latencies.append(now - (bt + e["t"]))
+            self.values += len(msg["e"])
+        if self.delay:
+            def finish():
+                request.write(b"")
+                request.finish()
+            reactor.callLater(self.delay, finish)
+            return server.NOT_DONE_YET
+        return b""
+
+class Replay():
+    def __init__(self, events, args, sink):
+        self.events = events
+        self.args = args
+        self.sink = sink
+        self.index = 0
+        self.dataMessages = 0
+        self.devices = set()
+        self.handled = []  # (ingest lag, time in onAdaptorData) for each data message
+
+    def start(self):
+        self.startTime = time.time()
+        self.next()
+
+    def next(self):
+        elapsed = time.time() - self.startTime
+        count = 0
+        while self.index < len(self.events):
+            t, type, message = self.events[self.index]
+            if self.args.max_speed:
+                if count >= CHUNK:
+                    break
+            elif t > elapsed:
+                break
+            self.replay(t, type, message)
+            self.index += 1
+            count += 1
+        if self.index < len(self.events):
+            if self.args.max_speed:
+                reactor.callLater(0, self.next)
+            else:
+                reactor.callLater(max(0, self.events[self.index][0] - (time.time() - self.startTime)), self.next)
+        else:
+            self.replayTime = time.time() - self.startTime
+            self.waitForUploads()
+
+    def simulate(self):
+        """ Replays the trace on a SimulatedClock, then runs the timers for drain_timeout more seconds """
+        self.recorder = Recorder()
+        self.alarms = []
+        data = [(t, message["timeStamp"]) for t, type, message in self.events if type == "data"]
+        # Trace times are relative to the first message, and the clock is set so that data arrives at its timeStamp
+        base = data[0][1] - data[0][0] if data else time.time()
+        clock = sch_app_a.SimulatedClock(base)
+        sch_app_a.useClock(clock)
+        self.startTime = time.time()
+        for t, type, message in self.events:
+            clock.advance(base + t)
+            self.replay(t, type, message)
+        clock.advance(clock.time() + self.args.drain_timeout)
+        self.replayTime = time.time() - self.startTime
+        self.simulatedTime = clock.time() - base
+
+    def sendMessage(self, msg, dest):
+        """ In place of App.sendMessage when simulating. Alarms to the client are recorded and acked. """
+        if dest == "conc":
+            self.alarms.append(msg["body"])
+            sch_app_a.timers.callLater(0, self.app.onConcMessage, {"body": {"n": msg["body"]["n"]}})
+
+    def replay(self, t, type, message):
+        if type == "configure":
+            self.app = sch_app_a.App(["sch_replay"])
+            self.app.verbose = self.args.verbose
+            if self.args.simulate:
+                self.app.sharedData = self.recorder
+                self.app.sendMessage = self.sendMessage
+            self.app.onConfigureMessage(message)
+        elif type == "service":
+            self.app.onAdaptorService(message)
+        elif type == "data":
+            self.dataMessages += 1
+            self.devices.add(message["id"])
+            if self.args.simulate:
+                self.handle(message, time.time())
+                return
+            message = dict(message)
+            message["timeStamp"] = time.time()
+            if self.args.max_speed:
+                due = message["timeStamp"]
+            else:
+                due = self.startTime + t
+            if self.args.dispatch == "thread":
+                reactor.callInThread(self.handle, message, due)
+            else:
+                self.handle(message, due)
+
+    def handle(self, message, due):
+        """ Ingest lag is the time from when the message was due until it reached onAdaptorData """
+        start = time.time()
+        self.app.onAdaptorData(message)
+        self.handled.append((start - due, time.time() - start))
+
+    def waitForUploads(self):
+        dm = self.app.dm
+        uploader = self.app.uploader
+        if (len(self.handled) == self.dataMessages and dm.pending == 0 and not dm.events and not dm.held and \
+                uploader.active == 0 and not uploader.queue and not uploader.eventQueue) or \
+                time.time() - self.startTime - self.replayTime > self.args.drain_timeout:
+            self.drainTime = time.time() - self.startTime - self.replayTime
+            reactor.stop()
+        else:
+            reactor.callLater(0.2, self.waitForUploads)
+
+    def reportSimulated(self):
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        out = sys.stdout
+        out.write("Simulated %.0f s of %d data messages from %d devices in %.2f s, %.0f times real time\n" % \
+            (self.simulatedTime, self.dataMessages, len(self.devices), self.replayTime, self.simulatedTime/self.replayTime))
+        if self.handled:
+            out.write("Ingest: %.0f messages/s, %.1f us per message in onAdaptorData\n" % \
+                (self.dataMessages/self.replayTime, sum(h[1] for h in self.handled)/len(self.handled)*1e6))
+        out.write("Stored %d values. Sent %d alarms\n" % (len(self.recorder.values), len(self.alarms)))
+        out.write("CPU: user %.2f s, system %.2f s. Max RSS: %.1f MB\n" % \
+            (usage.ru_utime, usage.ru_stime, usage.ru_maxrss/1024.0))
+
+    def writeOutput(self, fileName):
+        with open(fileName, "w") as f:
+            for t, name, value in sorted(self.recorder.values, key=lambda v: (v[0], v[1])):
+                f.write(json.dumps({"n": name, "t": round(t, 3), "v": value}) + "\n")
+            for body in self.alarms:
+                f.write(json.dumps({"alarm": body}) + "\n")
+
+    def report(self):
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        out = sys.stdout
+        out.write("Replayed %d data messages from %d devices in %.2f s (%s)\n" % \
+            (self.dataMessages, len(self.devices), self.replayTime, "maximum speed" if self.args.max_speed else "real time"))
+        if self.handled:
+            lags = sorted(h[0] for h in self.handled)
+            out.write("Ingest: %.0f messages/s, %.1f us per message in onAdaptorData\n" % \
+                (self.dataMessages/self.replayTime, sum(h[1] for h in self.handled)/len(self.handled)*1e6))
+            out.write("Ingest lag: p50 %.1f ms, p95 %.1f ms, max %.1f ms\n" % \
+                (lags[len(lags)//2]*1e3, lags[int(len(lags)*0.95)]*1e3, lags[-1]*1e3))
+        out.write("Uploads: %d posts, %d values, %d bytes, uploads finished %.2f s after the trace\n" % \
+            (self.sink.posts, self.sink.values, self.sink.bytes, self.drainTime))
+        latencies = sorted(self.sink.latencies)
+        if latencies:
+            out.write("Upload latency: p50 %.2f s, p95 %.2f s, max %.2f s\n" % \
+                (latencies[len(latencies)//2], latencies[int(len(latencies)*0.95)], latencies[-1]))
+        for lane in ("event", "bulk"):
+            h = sch_app_a.metrics.histograms.get("upload_latency_" + lane)
+            if h and h.count:
+                out.write("Upload latency, %s lane: %d posts, p50 %.2f s, p95 %.2f s, max %.2f s\n" % \
+                    (lane, h.count, h.percentile(0.5), h.percentile(0.95), h.max))
+        out.write("CPU: user %.2f s, system %.2f s. Max RSS: %.1f MB\n" % \
+            (usage.ru_utime, usage.ru_stime, usage.ru_maxrss/1024.0))
+
+def generateTrace(fileName, devices, duration, seed):
+    """ Writes a synthetic trace of SensorTags, PIRs and power plugs """
+    rnd = random.Random(seed)
+    events = []
+    config = {"accel": "True", "binary": "True", "power": "True", "temperature": "True", "humidity": "True"}
+    adaptors = []
+    for d in range(devices):
+        id = "ADT%d" % d
+        adaptors.append({"id": id, "name": "device", "friendly_name": "Sensor %d" % d})
+        kind = d % 3
+        if kind == 0:
+            characteristics = ["temperature", "humidity", "acceleration"]
+            for i in range(int(duration/3.0)):
+                t = i*3.0 + rnd.random()
+                events.append((t, "data", {"id": id, "characteristic": "acceleration", "timeStamp": t,
+                    "data": {"x": rnd.gauss(0, 0.05), "y": rnd.gauss(0, 0.05), "z": 1.0 + rnd.gauss(0, 0.05)}}))
+                if i % 20 == 0:
+                    events.append((t, "data", {"id": id, "characteristic": "temperature", "timeStamp": t,
+                        "data": round(20.0 + rnd.gauss(0, 0.5), 2)}))
+                    events.append((t, "data", {"id": id, "characteristic": "humidity", "timeStamp": t,
+                        "data": round(50.0 + rnd.gauss(0, 2), 1)}))
+        elif kind == 1:
+            characteristics = ["binary_sensor"]
+            t = rnd.expovariate(1/60.0)
+            state = "off"
+            while t < duration:
+                state = "on" if state == "off" else "off"
+                events.append((t, "data", {"id": id, "characteristic": "binary_sensor", "timeStamp": t, "data": state}))
+                t += rnd.expovariate(1/60.0)
+        else:
+            characteristics = ["power", "connected"]
+            for i in range(int(duration/10.0)):
+                t = i*10.0 + rnd.random()
+                events.append((t, "data", {"id": id, "characteristic": "power", "timeStamp": t,
+                    "data": round(rnd.choice([5.0, 60.0, 1500.0]) + rnd.gauss(0, 2), 1)}))
+        events.append((0.0, "service", {"id": id, "service": [{"characteristic": c} for c in characteristics]}))
+    events.sort(key=lambda e: (e[0], e[1] != "service"))
+    with open(fileName, "w") as f:
+        f.write(json.dumps({"t": 0.0, "type": "config", "message": config}) + "\n")
+        f.write(json.dumps({"t": 0.0, "type": "configure", "message": {"adaptors": adaptors}}) + "\n")
+        for t, type, message in events:
+            f.write(json.dumps({"t": round(t, 3), "type": type, "message": message}) + "\n")
+
+def readTrace(fileName):
+    config = {}
+    events = []
+    with open(fileName, "r") as f:
+        for line in f:
+            e = json.loads(line)
+            if e["type"] == "config":
+                config.update(e["message"])
+            else:
+                events.append((e["t"], e["type"], e["message"]))
+    return config, events
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Replay a trace of adaptor messages into the SCH app")
+    parser.add_argument("trace")
+    parser.add_argument("--generate", type=int, metavar="DEVICES", help="write a synthetic trace for this many devices")
+    parser.add_argument("--duration", type=float, default=600, help="length of a generated trace in seconds")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--max-speed", action="store_true", help="replay as fast as possible, not in real time")
+    parser.add_argument("--simulate", action="store_true",
+        help="run the app on a simulated clock at the recorded times, as fast as possible, without uploading")
+    parser.add_argument("--output", help="with --simulate, write the values stored and the alarms sent to this file")
+    parser.add_argument("--set", action="append", default=[], metavar="KEY=VALUE",
+        help="override an sch_app.config value. The value is parsed as JSON if possible")
+    parser.add_argument("--dispatch", choices=("reactor", "thread"), default="reactor",
+        help="call onAdaptorData in the reactor thread or, as cbcommslib does, from the reactor thread pool")
+    parser.add_argument("--send-delay", type=float, help="override SEND_DELAY")
+    parser.add_argument("--sink-delay", type=float, default=0, help="seconds the sink waits before answering a post")
+    parser.add_argument("--sink-status", type=int, default=200, help="status the sink answers posts with")
+    parser.add_argument("--drain-timeout", type=float, default=120,
+        help="longest time to wait for uploads after the trace. With --simulate, the simulated time to run on for")
+    parser.add_argument("--verbose", action="store_true", help="show all app log messages")
+    args = parser.parse_args(argv[1:])
+    if args.generate:
+        generateTrace(args.trace, args.generate, args.duration, args.seed)
+        return
+    config, events = readTrace(args.trace)
+    for s in args.set:
+        key, value = s.split("=", 1)
+        try:
+            config[key] = json.loads(value)
+        except ValueError:
+            config[key] = value
+    if args.send_delay is not None:
+        sch_app_a.SEND_DELAY = args.send_delay
+    config["trace_file"] = ""
+    if args.simulate:
+        config["metrics_port"] = 0
+        with open(cbconfig.CB_CONFIG_DIR + "sch_app.config", "w") as f:
+            json.dump(config, f)
+        replay = Replay(events, args, None)
+        replay.simulate()
+        replay.reportSimulated()
+        if args.output:
+            replay.writeOutput(args.output)
+        return
+    sink = Sink(args.sink_delay, args.sink_status)
+    port = reactor.listenTCP(0, server.Site(sink), interface="127.0.0.1")
+    config["series_url"] = "http://127.0.0.1:%d/series/" % port.getHost().port
+    with open(cbconfig.CB_CONFIG_DIR + "sch_app.config", "w") as f:
+        json.dump(config, f)
+    replay = Replay(events, args, sink)
+    reactor.callWhenRunning(replay.start)
+    reactor.run()
+    replay.report()
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+# test_timewindow.py
+# Copyright (C) ContinuumBridge Limited, 2014 - All Rights Reserved
+# Unauthorized copying of this file, via any medium is strictly prohibited
+# Proprietary and confidential
+# Written by Peter Claydon
+#
+"""
+Tests of TimeWindow in Europe/London, across the DST changes of 2024-03-31 (01:00
+GMT becomes 02:00 BST) and 2024-10-27 (02:00 BST becomes 01:00 GMT), for windows
+that do and do not cross midnight. Times are given in UTC, so that the expected
+results do not depend on the code under test. Run with:
+
+    python -m unittest test_timewindow
+"""
+import os
+import time
+import calendar
+import unittest
+import sch_replay  # Installs the stand-ins for the bridge libraries
+import sch_app_a
+
+def utc(*args):
+    """ Epoch of a UTC time (year, month, day, hour, minute) """
+    return calendar.timegm(args + (0,)*(6 - len(args)))
+
+class TimeWindowTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.savedTZ = os.environ.get("TZ")
+        os.environ["TZ"] = "Europe/London"
+        time.tzset()
+
+    @classmethod
+    def tearDownClass(cls):
+        if cls.savedTZ is None:
+            del os.environ["TZ"]
+        else:
+            os.environ["TZ"] = cls.savedTZ
+        time.tzset()
+
+    def check(self, window, cases):
+        for t, expected in cases:
+            self.assertEqual(window.contains(t), expected, time.strftime("%Y-%m-%d %H:%M %Z", time.localtime(t)))
+
+    def test_day_window(self):
+        self.check(sch_app_a.TimeWindow("09:00", "17:00"), [
+            (utc(2024, 1, 10, 8, 59), False),
+            (utc(2024, 1, 10, 9, 0), True),
+            (utc(2024, 1, 10, 16, 59), True),
+            (utc(2024, 1, 10, 17, 0), False)])
+
+    def test_day_window_in_summer_time(self):
+        # 09:00 BST is 08:00 UTC
+        self.check(sch_app_a.TimeWindow("09:00", "17:00"), [
+            (utc(2024, 7, 10, 7, 59), False),
+            (utc(2024, 7, 10, 8, 0), True),
+            (utc(2024, 7, 10, 15, 59), True),
+            (utc(2024, 7, 10, 16, 0), False)])
+
+    def test_crossing_midnight(self):
+        self.check(sch_app_a.TimeWindow("23:00", "07:00"), [
+            (utc(2024, 1, 10, 22, 59), False),
+            (utc(2024, 1, 10, 23, 0), True),
+            (utc(2024, 1, 11, 0, 0), True),
+            (utc(2024, 1, 11, 6, 59), True),
+            (utc(2024, 1, 11, 7, 0), False),
+            (utc(2024, 1, 11, 12, 0), False)])
+
+    def test_spring_forward(self):
+        # 00:30 is still GMT, 07:00 is BST, 06:00 UTC
+        self.check(sch_app_a.TimeWindow("00:30", "07:00"), [
+            (utc(2024, 3, 31, 0, 29), False),
+            (utc(2024, 3, 31, 0, 30), True),
+            (utc(2024, 3, 31, 1, 30), True),
+            (utc(2024, 3, 31, 5, 59), True),
+            (utc(2024, 3, 31, 6, 0), False)])
+
+    def test_spring_forward_crossing_midnight(self):
+        # From 22:00 GMT on the 30th to 06:00 BST, 05:00 UTC, on the 31st
+        self.check(sch_app_a.TimeWindow("22:00", "06:00"), [
+            (utc(2024, 3, 30, 21, 59), False),
+            (utc(2024, 3, 30, 22, 0), True),
+            (utc(2024, 3, 31, 4, 59), True),
+            (utc(2024, 3, 31, 5, 0), False),
+            (utc(2024, 3, 31, 20, 59), False),
+            (utc(2024, 3, 31, 21, 0), True)])
+
+    def test_fall_back(self):
+        # 00:30 BST is 23:30 UTC the day before, 07:00 is GMT
+        self.check(sch_app_a.TimeWindow("00:30", "07:00"), [
+            (utc(2024, 10, 26, 23, 29), False),
+            (utc(2024, 10, 26, 23, 30), True),
+            (utc(2024, 10, 27, 1, 30), True),
+            (utc(2024, 10, 27, 6, 59), True),
+            (utc(2024, 10, 27, 7, 0), False)])
+
+    def test_fall_back_crossing_midnight(self):
+        # From 22:00 BST, 21:00 UTC, on the 26th to 06:00 GMT on the 27th
+        self.check(sch_app_a.TimeWindow("22:00", "06:00"), [
+            (utc(2024, 10, 26, 20, 59), False),
+            (utc(2024, 10, 26, 21, 0), True),
+            (utc(2024, 10, 27, 5, 59), True),
+            (utc(2024, 10, 27, 6, 0), False),
+            (utc(2024, 10, 27, 21, 59), False),
+            (utc(2024, 10, 27, 22, 0), True)])
+
+    def test_out_of_order(self):
+        # Times jump between the two changes, so that the cached day is refreshed back and forth
+        cases = [
+            (utc(2024, 10, 27, 5, 59), True),
+            (utc(2024, 3, 31, 4, 59), True),
+            (utc(2024, 10, 26, 21, 0), True),
+            (utc(2024, 3, 31, 5, 0), False),
+            (utc(2024, 10, 26, 20, 59), False),
+            (utc(2024, 3, 30, 22, 0), True),
+            (utc(2024, 10, 27, 6, 0), False),
+            (utc(2024, 3, 30, 21, 59), False)]
+        self.check(sch_app_a.TimeWindow("22:00", "06:00"), cases)
+        self.assertEqual(sch_app_a.TimeWindow("22:00", "06:00").containsMany([t for t, expected in cases]),
+                         [expected for t, expected in cases])
+
+    def test_next_end(self):
+        window = sch_app_a.TimeWindow("22:00", "06:00")
+        # Before the end on the same day
+        self.assertEqual(window.nextEnd(utc(2024, 3, 30, 23, 0)), utc(2024, 3, 31, 5, 0))
+        self.assertEqual(window.nextEnd(utc(2024, 10, 27, 1, 30)), utc(2024, 10, 27, 6, 0))
+        # After the end, so the next day's
+        self.assertEqual(window.nextEnd(utc(2024, 3, 31, 5, 0)), utc(2024, 4, 1, 5, 0))
+        self.assertEqual(window.nextEnd(utc(2024, 10, 26, 12, 0)), utc(2024, 10, 27, 6, 0))
+        window = sch_app_a.TimeWindow("09:00", "17:00")
+        self.assertEqual(window.nextEnd(utc(2024, 10, 26, 17, 0)), utc(2024, 10, 27, 17, 0))
+        self.assertEqual(window.nextEnd(utc(2024, 3, 30, 16, 59)), utc(2024, 3, 30, 17, 0))
+
+if __name__ == '__main__':
+    unittest.main()